@@ -0,0 +1,204 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from starlette.concurrency import run_in_threadpool
+
+from app.config import (IMAGE_CACHE_MAX_BYTES, IMAGE_CACHE_TTL, IMAGE_CACHE_DIR, IMAGE_CACHE_DIR_MAX_BYTES,
+                        IMAGE_CACHE_DIR_SWEEP_INTERVAL)
+from app.utils import encoder_settings
+
+
+class DiskCache:
+    ''' Second cache tier storing one file per key inside a directory.
+
+    The directory may be shared by several processes. Every sweep_interval
+    seconds a put removes the files older than ttl, then the oldest files
+    until the directory fits in max_bytes.
+    '''
+
+    def __init__(self, directory: str, ttl: float, max_bytes: int, sweep_interval: float):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        os.makedirs(directory, exist_ok=True)
+
+        self._next_sweep = time.monotonic() + sweep_interval
+        self._sweep_lock = threading.Lock()
+
+        # Metrics
+        self._swept = 0
+
+    def _path(self, key):
+        digest = hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, key, value: bytes):
+        path = self._path(key)
+        try:
+            # Unique name so concurrent writers, in this or another process, never share a file
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(value)
+                # Atomic so other replicas never read a partial file
+                os.replace(tmp_path, path)
+            except OSError:
+                os.remove(tmp_path)
+                raise
+        except OSError:
+            pass
+        self._maybe_sweep()
+
+    def _maybe_sweep(self):
+        if time.monotonic() < self._next_sweep or not self._sweep_lock.acquire(blocking=False):
+            return
+        try:
+            self.sweep()
+        finally:
+            self._next_sweep = time.monotonic() + self.sweep_interval
+            self._sweep_lock.release()
+
+    def sweep(self):
+        ''' Remove expired files, then the least recently written ones above max_bytes '''
+        now = time.time()
+        files = []
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    if entry.is_file(follow_symlinks=False):
+                        files.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError:
+            return
+
+        total = sum(size for _, size, _ in files)
+        files.sort()
+        for mtime, size, path in files:
+            if now - mtime <= self.ttl and total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self._swept += 1
+
+    def stats(self):
+        return {'directory': self.directory,
+                'max_bytes': self.max_bytes,
+                'swept': self._swept}
+
+
+class ImageCache:
+    ''' Thread-safe LRU cache of encoded images bounded by total bytes and TTL '''
+
+    def __init__(self, max_bytes: int, ttl: float, disk: DiskCache = None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk = disk
+
+        # key -> (value, expire_at)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        # Metrics
+        self._hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    def _remove(self, key):
+        value, _ = self._entries.pop(key)
+        self._bytes -= len(value)
+
+    def _store(self, key, value: bytes):
+        if key in self._entries:
+            self._remove(key)
+        # Never keep a value bigger than the whole budget
+        if len(value) > self.max_bytes:
+            return
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._bytes += len(value)
+        while self._bytes > self.max_bytes:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self._evictions += 1
+
+    def _get_memory(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expire_at = entry
+                if expire_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self._hits += 1
+                    return value
+                self._remove(key)
+                self._expirations += 1
+        return None
+
+    def _got_disk(self, key, value):
+        with self._lock:
+            if value is None:
+                self._misses += 1
+            else:
+                self._disk_hits += 1
+                self._store(key, value)
+
+    async def get(self, key):
+        ''' Return the cached value of key, or None, reading the disk tier in the threadpool '''
+        value = self._get_memory(key)
+        if value is None:
+            value = await run_in_threadpool(self.disk.get, key) if self.disk is not None else None
+            self._got_disk(key, value)
+        return value
+
+    async def put(self, key, value: bytes):
+        with self._lock:
+            self._store(key, value)
+        if self.disk is not None:
+            await run_in_threadpool(self.disk.put, key, value)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries),
+                    'bytes': self._bytes,
+                    'max_bytes': self.max_bytes,
+                    'hits': self._hits,
+                    'disk_hits': self._disk_hits,
+                    'misses': self._misses,
+                    'evictions': self._evictions,
+                    'expirations': self._expirations,
+                    'disk': self.disk.stats() if self.disk is not None else None}
+
+
+def image_cache_key(path: str, boxes, options: tuple = ()):
+    ''' Key of a rendered image: S3 path, the boxes drawn on it, its variant and the encoder settings '''
+    return (path, tuple(tuple(box) for box in boxes), tuple(options), encoder_settings())
+
+
+# Cache of rendered JPEG images shared by every route
+image_cache = ImageCache(IMAGE_CACHE_MAX_BYTES, IMAGE_CACHE_TTL,
+                         DiskCache(IMAGE_CACHE_DIR, IMAGE_CACHE_TTL, IMAGE_CACHE_DIR_MAX_BYTES,
+                                   IMAGE_CACHE_DIR_SWEEP_INTERVAL) if IMAGE_CACHE_DIR else None)
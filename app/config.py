@@ -4,7 +4,7 @@ MYSQL_CONFIG = {
     "host": os.getenv('MYSQL_HOST'),
     "port": int(os.getenv('MYSQL_PORT')),
     "user": os.getenv('MYSQL_USER'),
-    "passwd": os.getenv('MYSQL_PASSWORD'),
+    "password": os.getenv('MYSQL_PASSWORD'),
     "db": os.getenv('MYSQL_DB'),
 }
 
@@ -12,3 +12,99 @@ MYSQL_CONFIG_FADE = {
     **MYSQL_CONFIG,
     "db": 'face_recognition'
 }
+
+# Connection pool
+MYSQL_POOL_MIN_SIZE = int(os.getenv('MYSQL_POOL_MIN_SIZE', '1'))
+MYSQL_POOL_MAX_SIZE = int(os.getenv('MYSQL_POOL_MAX_SIZE', '10'))
+# Seconds to wait for a free connection before giving up
+MYSQL_POOL_TIMEOUT = float(os.getenv('MYSQL_POOL_TIMEOUT', '10'))
+# Idle connections older than this (seconds) are closed instead of reused
+MYSQL_POOL_RECYCLE = float(os.getenv('MYSQL_POOL_RECYCLE', '300'))
+
+# S3
+S3_ENDPOINT = os.getenv('S3_ENDPOINT')
+S3_ACCESS_KEY = os.getenv('S3_ACCESS_KEY')
+S3_SECRET_KEY = os.getenv('S3_SECRET_KEY')
+S3_MAX_POOL_CONNECTIONS = int(os.getenv('S3_MAX_POOL_CONNECTIONS', '20'))
+S3_MAX_ATTEMPTS = int(os.getenv('S3_MAX_ATTEMPTS', '3'))
+
+# Rendered image cache
+IMAGE_CACHE_MAX_BYTES = int(os.getenv('IMAGE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+IMAGE_CACHE_TTL = float(os.getenv('IMAGE_CACHE_TTL', '600'))
+# Optional directory (e.g. a volume shared by replicas) used as second tier
+IMAGE_CACHE_DIR = os.getenv('IMAGE_CACHE_DIR')
+# Budget of the directory, expired files and then the oldest ones are removed every sweep interval
+IMAGE_CACHE_DIR_MAX_BYTES = int(os.getenv('IMAGE_CACHE_DIR_MAX_BYTES', str(1024 * 1024 * 1024)))
+IMAGE_CACHE_DIR_SWEEP_INTERVAL = float(os.getenv('IMAGE_CACHE_DIR_SWEEP_INTERVAL', '60'))
+
+# Largest number of ids accepted by the result batch endpoint
+RESULT_BATCH_MAX_IDS = int(os.getenv('RESULT_BATCH_MAX_IDS', '100'))
+# Images rendered at once by one batch request, must not exceed RENDER_QUEUE_DEPTH or
+# a batch of uncached images is turned away by the render pool
+RESULT_BATCH_CONCURRENCY = int(os.getenv('RESULT_BATCH_CONCURRENCY', '8'))
+
+# Image listing
+IMAGES_PAGE_SIZE = int(os.getenv('IMAGES_PAGE_SIZE', '100'))
+IMAGES_MAX_PAGE_SIZE = int(os.getenv('IMAGES_MAX_PAGE_SIZE', '1000'))
+# Largest number of ids accepted by the bulk image endpoint
+IMAGES_BULK_MAX_IDS = int(os.getenv('IMAGES_BULK_MAX_IDS', '100'))
+# Images downloaded and rendered at once by one bulk request, must not exceed RENDER_QUEUE_DEPTH
+IMAGES_BULK_CONCURRENCY = int(os.getenv('IMAGES_BULK_CONCURRENCY', '8'))
+
+# Face merging
+# Minimum IoU for a result to join a face, 0 means any overlap
+FACE_MERGE_IOU_THRESHOLD = float(os.getenv('FACE_MERGE_IOU_THRESHOLD', '0'))
+FACE_MERGE_CELL_SIZE = int(os.getenv('FACE_MERGE_CELL_SIZE', '128'))
+# Images whose result rows and merged faces are kept in memory
+FACE_CACHE_MAX_IMAGES = int(os.getenv('FACE_CACHE_MAX_IMAGES', '1024'))
+
+# Image rendering
+# Number of render processes of each gunicorn worker, 0 renders in the threadpool of the worker.
+# By default the cores are shared out between the WEB_CONCURRENCY gunicorn workers. Without
+# WEB_CONCURRENCY the image already starts a gunicorn worker per core, so each gets 1.
+WEB_CONCURRENCY = int(os.getenv('WEB_CONCURRENCY', '0'))
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', str(
+    max((os.cpu_count() or 1) // WEB_CONCURRENCY, 1) if WEB_CONCURRENCY > 0 else 1)))
+# Renders waiting or running at once before new ones are rejected
+RENDER_QUEUE_DEPTH = int(os.getenv('RENDER_QUEUE_DEPTH', '64'))
+RENDER_TIMEOUT = float(os.getenv('RENDER_TIMEOUT', '10'))
+
+# JPEG encoding of rendered images, the quality query parameter overrides JPEG_QUALITY
+JPEG_QUALITY = int(os.getenv('JPEG_QUALITY', '75'))
+JPEG_PROGRESSIVE = os.getenv('JPEG_PROGRESSIVE', '').lower() in ('1', 'true', 'yes')
+JPEG_OPTIMIZE = os.getenv('JPEG_OPTIMIZE', '').lower() in ('1', 'true', 'yes')
+# Encode with the quantization tables and subsampling of the source JPEG
+# instead of JPEG_QUALITY, which keeps its quality without growing the file
+JPEG_KEEP_QUANTIZATION = os.getenv('JPEG_KEEP_QUANTIZATION', '').lower() in ('1', 'true', 'yes')
+
+# Seconds between two attempts of the startup warm-up when one fails
+WARMUP_RETRY_INTERVAL = float(os.getenv('WARMUP_RETRY_INTERVAL', '5'))
+
+# Rows per Parquet row group or Arrow record batch of the result export
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '50000'))
+
+# Keys whose coalescing counters are kept by each single-flight group
+SINGLEFLIGHT_MAX_KEYS = int(os.getenv('SINGLEFLIGHT_MAX_KEYS', '256'))
+
+# Cache-Control max-age (seconds) of binary images addressed by id
+IMAGE_MAX_AGE = int(os.getenv('IMAGE_MAX_AGE', '3600'))
+# Default padding of face crops, as a fraction of the face size
+FACE_CROP_PADDING = float(os.getenv('FACE_CROP_PADDING', '0.2'))
+
+# Live feeds
+# Seconds between two checks for a new result
+LIVE_POLL_INTERVAL = float(os.getenv('LIVE_POLL_INTERVAL', '1'))
+# Seconds of silence after which a keep-alive comment is sent
+LIVE_KEEPALIVE = float(os.getenv('LIVE_KEEPALIVE', '15'))
+
+# Result statistics
+# Seconds after its end before a time bucket is considered closed and cached
+STATS_GRACE = float(os.getenv('STATS_GRACE', '120'))
+# Number of filter combinations whose closed buckets are kept in memory
+STATS_CACHE_MAX_KEYS = int(os.getenv('STATS_CACHE_MAX_KEYS', '64'))
+
+# Metrics
+# Add a Server-Timing header to every response, not only those asking for it
+SERVER_TIMING = os.getenv('SERVER_TIMING', '').lower() in ('1', 'true', 'yes')
+# Directory shared by the gunicorn workers to aggregate their histograms
+PROMETHEUS_MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR')
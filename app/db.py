@@ -0,0 +1,177 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+import aiomysql
+
+from app.metrics import timed
+
+from app.config import (MYSQL_CONFIG, MYSQL_CONFIG_FADE,
+                        MYSQL_POOL_MIN_SIZE, MYSQL_POOL_MAX_SIZE,
+                        MYSQL_POOL_TIMEOUT, MYSQL_POOL_RECYCLE)
+
+
+class PoolTimeout(Exception):
+    ''' Raised when no connection becomes free within the checkout timeout '''
+
+
+class ConnectionPool:
+    ''' Pool of aiomysql connections shared by every request of the event loop '''
+
+    def __init__(self, config: dict, min_size: int, max_size: int,
+                 timeout: float, recycle: float):
+        self.config = config
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.recycle = recycle
+
+        # Idle connections as (connection, last_used) pairs, most recent last
+        self._idle = []
+        # One slot per connection that may exist at the same time, created
+        # lazily so it binds to the event loop that serves requests
+        self._slots = None
+
+        # Metrics
+        self._in_use = 0
+        self._created = 0
+        self._discarded = 0
+        self._checkouts = 0
+        self._timeouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    async def _connect(self):
+        connection = await aiomysql.connect(**self.config, autocommit=True)
+        self._created += 1
+        return connection
+
+    def _discard(self, connection):
+        self._discarded += 1
+        connection.close()
+
+    async def open(self):
+        ''' Fill the pool up to min_size '''
+        for _ in range(self.min_size - len(self._idle)):
+            self._idle.append((await self._connect(), time.monotonic()))
+
+    async def close(self):
+        ''' Close every idle connection '''
+        while self._idle:
+            connection, _ = self._idle.pop()
+            await connection.ensure_closed()
+
+    async def _checkout(self):
+        if self._slots is None:
+            self._slots = asyncio.BoundedSemaphore(self.max_size)
+
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self._timeouts += 1
+            raise PoolTimeout("No database connection available")
+        waited = time.monotonic() - started
+
+        try:
+            connection = None
+            while connection is None:
+                if not self._idle:
+                    connection = await self._connect()
+                    break
+                connection, last_used = self._idle.pop()
+
+                # Recycle connections that sat idle for too long
+                if time.monotonic() - last_used > self.recycle:
+                    self._discard(connection)
+                    connection = None
+                    continue
+
+                # Health check before handing it out
+                try:
+                    await connection.ping(reconnect=False)
+                except Exception:
+                    self._discard(connection)
+                    connection = None
+        except BaseException:
+            self._slots.release()
+            raise
+
+        self._in_use += 1
+        self._checkouts += 1
+        self._wait_total += waited
+        self._wait_max = max(self._wait_max, waited)
+        return connection
+
+    def _checkin(self, connection, broken: bool):
+        self._in_use -= 1
+        if broken or connection.closed:
+            self._discard(connection)
+        else:
+            self._idle.append((connection, time.monotonic()))
+        self._slots.release()
+
+    @asynccontextmanager
+    async def connection(self):
+        ''' Borrow a connection, it is returned to the pool on exit.
+
+        A connection that leaves the block with an exception is closed instead
+        of being reused, since its state (e.g. an unread result) is unknown.
+        '''
+        with timed('db_connect'):
+            connection = await self._checkout()
+        broken = False
+        try:
+            yield connection
+        except BaseException:
+            broken = True
+            raise
+        finally:
+            self._checkin(connection, broken)
+
+    def stats(self):
+        return {'min_size': self.min_size,
+                'max_size': self.max_size,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'created': self._created,
+                'discarded': self._discarded,
+                'checkouts': self._checkouts,
+                'checkout_timeouts': self._timeouts,
+                'checkout_wait_total': self._wait_total,
+                'checkout_wait_max': self._wait_max}
+
+
+async def iter_rows(pool: ConnectionPool, query: str, args=None, batch_size: int = 1000):
+    ''' Yield rows of query one by one with an unbuffered server-side cursor.
+
+    The connection stays borrowed until the generator is exhausted or closed,
+    so only batch_size rows are held in memory at a time. If the generator is
+    closed early the connection is dropped rather than draining the result.
+    '''
+    async with pool.connection() as connection:
+        cursor = await connection.cursor(aiomysql.SSDictCursor)
+        with timed('db_query'):
+            await cursor.execute(query, args)
+        while True:
+            rows = await cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+        await cursor.close()
+
+
+def _create_pool(config: dict):
+    return ConnectionPool(config,
+                          min_size=MYSQL_POOL_MIN_SIZE,
+                          max_size=MYSQL_POOL_MAX_SIZE,
+                          timeout=MYSQL_POOL_TIMEOUT,
+                          recycle=MYSQL_POOL_RECYCLE)
+
+
+# Pool for MYSQL_DB (FaceImage, Gender, Race, Age)
+pool = _create_pool(MYSQL_CONFIG)
+
+# Pool for the face_recognition database (image and its result tables)
+pool_fade = _create_pool(MYSQL_CONFIG_FADE)
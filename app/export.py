@@ -0,0 +1,140 @@
+import json
+from decimal import Decimal
+from typing import AsyncIterable, AsyncIterator, Dict, List, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+from app.config import EXPORT_BATCH_SIZE
+
+# Media type and file extension of each export format
+EXPORT_FORMATS = {'csv': ('text/csv', 'csv'),
+                  'ndjson': ('application/x-ndjson', 'ndjson'),
+                  'parquet': ('application/vnd.apache.parquet', 'parquet'),
+                  'arrow': ('application/vnd.apache.arrow.stream', 'arrows')}
+
+# Formats written with pyarrow
+ARROW_FORMATS = ('parquet', 'arrow')
+
+
+def import_pyarrow():
+    ''' Return pyarrow, or None when it is not installed.
+
+    pyarrow has no wheels for the Alpine base image, so it is optional and
+    only the Arrow formats need it.
+    '''
+    try:
+        import pyarrow
+        import pyarrow.ipc  # noqa: F401
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        return None
+    return pyarrow
+
+
+def _json_default(value):
+    # DECIMAL columns stay numbers, anything else (e.g. datetime) becomes a string
+    return float(value) if isinstance(value, Decimal) else str(value)
+
+
+async def iter_ndjson(rows: AsyncIterable[dict], chunk_size: int = 64 * 1024) -> AsyncIterator[bytes]:
+    ''' Yield one JSON object per row in chunks of about chunk_size bytes '''
+    lines = []
+    size = 0
+    async for row in rows:
+        line = json.dumps(row, default=_json_default) + '\n'
+        lines.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield ''.join(lines).encode('utf-8')
+            lines = []
+            size = 0
+    if lines:
+        yield ''.join(lines).encode('utf-8')
+
+
+async def iter_columns(rows: AsyncIterable[dict], columns: List[str],
+                       batch_size: int = EXPORT_BATCH_SIZE) -> AsyncIterator[Dict[str, list]]:
+    ''' Group rows into {column: values} batches of up to batch_size rows '''
+    batch = {column: [] for column in columns}
+    count = 0
+    async for row in rows:
+        for column in columns:
+            batch[column].append(row[column])
+        count += 1
+        if count >= batch_size:
+            yield batch
+            batch = {column: [] for column in columns}
+            count = 0
+    if count:
+        yield batch
+
+
+class _ChunkSink:
+    ''' Write-only file object collecting what a pyarrow writer writes until it is drained '''
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _array(pa, values: list, arrow_type):
+    try:
+        return pa.array(values, type=arrow_type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # DECIMAL columns arrive as Decimal
+        if not pa.types.is_floating(arrow_type):
+            raise
+        return pa.array([None if value is None else float(value) for value in values], type=arrow_type)
+
+
+async def iter_arrow(rows: AsyncIterable[dict], columns: List[Tuple[str, str]], format: str,
+                     batch_size: int = EXPORT_BATCH_SIZE) -> AsyncIterator[bytes]:
+    ''' Yield rows as a Parquet file or an Arrow IPC stream, written one batch at a time.
+
+    columns are (name, Arrow type alias) pairs. Each batch becomes a Parquet
+    row group or a zstd compressed Arrow record batch and is sent as soon as
+    it is written.
+    '''
+    pa = import_pyarrow()
+    schema = pa.schema([(name, pa.type_for_alias(type_alias)) for name, type_alias in columns])
+    sink = _ChunkSink()
+    if format == 'parquet':
+        writer = pa.parquet.ParquetWriter(sink, schema)
+
+        def write(record_batch):
+            writer.write_table(pa.Table.from_batches([record_batch]))
+    else:
+        writer = pa.ipc.new_stream(sink, schema, options=pa.ipc.IpcWriteOptions(compression='zstd'))
+        write = writer.write_batch
+
+    async for batch in iter_columns(rows, schema.names, batch_size):
+        record_batch = pa.RecordBatch.from_arrays([_array(pa, batch[field.name], field.type) for field in schema],
+                                                  schema=schema)
+        # Encoding and compression release the GIL, keep them off the event loop
+        await run_in_threadpool(write, record_batch)
+        data = sink.drain()
+        if data:
+            yield data
+
+    await run_in_threadpool(writer.close)
+    yield sink.drain()
@@ -0,0 +1,101 @@
+import asyncio
+import json
+import logging
+
+from fastapi.encoders import jsonable_encoder
+
+from app.config import LIVE_POLL_INTERVAL, LIVE_KEEPALIVE
+from app.metrics import use_spans
+
+logger = logging.getLogger("api")
+
+
+class LiveFeed:
+    ''' Push the latest payload to every subscriber as Server-Sent Events.
+
+    A single background task calls fetch_marker every interval seconds, only
+    when the marker changes is build_payload(marker) called, and the event is
+    fanned out to all subscribers. The watcher runs while there is at least
+    one subscriber, so the database load does not depend on how many there
+    are. A subscriber joining late gets the last event immediately.
+    '''
+
+    def __init__(self, event: str, fetch_marker, build_payload,
+                 interval: float = LIVE_POLL_INTERVAL, keepalive: float = LIVE_KEEPALIVE):
+        self.event = event
+        self.fetch_marker = fetch_marker
+        self.build_payload = build_payload
+        self.interval = interval
+        self.keepalive = keepalive
+
+        self._subscribers = set()
+        self._task = None
+        self._marker = None
+        self._last_event = None
+
+        # Metrics
+        self._published = 0
+
+    def _format(self, payload) -> str:
+        return f"event: {self.event}\ndata: {json.dumps(jsonable_encoder(payload))}\n\n"
+
+    @staticmethod
+    def _offer(queue: asyncio.Queue, event: str):
+        # Slow subscribers only need the newest event
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(event)
+
+    async def _watch(self):
+        # The task outlives the request of the first subscriber
+        use_spans(None)
+        while True:
+            try:
+                marker = await self.fetch_marker()
+                if marker is not None and marker != self._marker:
+                    payload = await self.build_payload(marker)
+                    self._marker = marker
+                    self._last_event = self._format(payload)
+                    self._published += 1
+                    for queue in self._subscribers:
+                        self._offer(queue, self._last_event)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Live feed %s failed to poll", self.event)
+            await asyncio.sleep(self.interval)
+
+    def _start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._watch())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        # Payloads are not kept while nobody watches, they would go stale
+        self._marker = None
+        self._last_event = None
+
+    async def subscribe(self):
+        ''' Yield Server-Sent Events until the client goes away '''
+        queue = asyncio.Queue(maxsize=1)
+        if self._last_event is not None:
+            queue.put_nowait(self._last_event)
+        self._subscribers.add(queue)
+        self._start()
+        try:
+            while True:
+                try:
+                    yield await asyncio.wait_for(queue.get(), self.keepalive)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+        finally:
+            self._subscribers.discard(queue)
+            if not self._subscribers:
+                self.stop()
+
+    def stats(self):
+        return {'subscribers': len(self._subscribers),
+                'watching': self._task is not None,
+                'published': self._published}
@@ -1,22 +1,32 @@
-import os
-from typing import Tuple
-import csv
-from io import StringIO
 import time
+import_started = time.perf_counter()
+
+from typing import List
+from contextlib import asynccontextmanager
+import asyncio
 
 # fastapi
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException, Request
 from starlette.middleware.cors import CORSMiddleware
-from starlette.responses import StreamingResponse
-from pydantic import BaseModel
+from starlette.responses import JSONResponse, StreamingResponse
 
 # sql
-import pymysql
-from pymysql.cursors import DictCursor
+from aiomysql import DictCursor
+from app import db
 
 # Image
-from PIL import Image, ImageDraw, ImageFont
-from app.utils import image_to_data_uri
+from app.utils import bytes_to_data_uri, iter_csv, iter_gzip, RenderOptions
+from app.cache import image_cache, image_cache_key
+from app.singleflight import SingleFlight
+from app.render import render_pool, render_flight, get_image, parse_render_options, render_options_query, RenderBusy
+from app.live import LiveFeed
+from app.stats import StatsRollup
+from app.query import ResultFilter, result_csv_query, result_stats_query, RESULT_EXPORT_COLUMNS
+from app.export import EXPORT_FORMATS, ARROW_FORMATS, import_pyarrow, iter_ndjson, iter_arrow
+from app.metrics import TimingMiddleware, metrics_response, register_stats, timed
+from app.responses import make_etag, is_not_modified, not_modified_response, binary_response
+from app.startup import startup
+from app.config import WARMUP_RETRY_INTERVAL, RESULT_BATCH_MAX_IDS, RESULT_BATCH_CONCURRENCY
 
 # S3
 from app import s3
@@ -28,253 +38,266 @@ logger = logging.getLogger("api")
 # routes
 from app import routes
 
-# Environment variables
-MYSQL_HOST = os.getenv('MYSQL_HOST')
-MYSQL_USER = os.getenv('MYSQL_USER')
-MYSQL_PASSWORD = os.getenv('MYSQL_PASSWORD')
-MYSQL_PORT = int(os.getenv('MYSQL_PORT'))
-MYSQL_DB = os.getenv('MYSQL_DB')
+startup.steps['import'] = time.perf_counter() - import_started
+
+
+async def run_step(name: str, awaitable):
+    with startup.step(name):
+        await awaitable
+
+
+async def warm_up():
+    ''' Open connections and load what the first requests would otherwise wait for '''
+    await asyncio.gather(run_step('db_pool', db.pool.open()),
+                         run_step('db_pool_face_recognition', db.pool_fade.open()),
+                         run_step('s3_client', s3.open_client()),
+                         run_step('render_workers', render_pool.start()))
 
-app = FastAPI()
 
-app.add_middleware(CORSMiddleware, allow_origins=['*'])
+async def warm_up_until_ready():
+    while not startup.ready:
+        startup.attempts += 1
+        try:
+            await warm_up()
+        except Exception as exc:
+            startup.error = repr(exc)
+            logger.exception("Warm-up failed, retrying in %s seconds", WARMUP_RETRY_INTERVAL)
+            await asyncio.sleep(WARMUP_RETRY_INTERVAL)
+        else:
+            startup.error = None
+            startup.ready = True
+            startup.log()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Serve liveness right away and warm up in the background, /healthz/ready
+    # answers 503 until it is done. Requests meanwhile connect lazily.
+    if RESULT_BATCH_CONCURRENCY > render_pool.queue_depth:
+        logger.warning("RESULT_BATCH_CONCURRENCY %s exceeds RENDER_QUEUE_DEPTH %s, batches of uncached "
+                       "images will be rejected", RESULT_BATCH_CONCURRENCY, render_pool.queue_depth)
+    warm_up_task = asyncio.ensure_future(warm_up_until_ready())
+    yield
+    warm_up_task.cancel()
+    result_feed.stop()
+    routes.images.image_feed.stop()
+    await db.pool.close()
+    await db.pool_fade.close()
+    await s3.close_client()
+    render_pool.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
+
+app.add_middleware(CORSMiddleware, allow_origins=['*'], allow_headers=['X-Server-Timing'],
+                   expose_headers=['X-Next-Cursor', 'ETag', 'Content-Range', 'Server-Timing'])
+app.add_middleware(TimingMiddleware)
 
 # including routes
 app.include_router(routes.images.router, prefix="/_api/images", tags=["images"])
 
 
-# TODO: use method from utils.py instead
-def draw_box(img, lt_corner: Tuple[int], rb_corner: Tuple[int], title: str):
-    draw = ImageDraw.Draw(img)
-    draw.rectangle([lt_corner, rb_corner], outline="red", width=2)
-    draw.text(lt_corner, title, font=ImageFont.truetype(
-        "app/font/RobotoMono-Bold.ttf", size=16))
-    return img
+@app.exception_handler(db.PoolTimeout)
+def database_busy(request: Request, exc: db.PoolTimeout):
+    return JSONResponse(status_code=503, content={"detail": str(exc)})
+
+
+@app.exception_handler(RenderBusy)
+def render_busy(request: Request, exc: RenderBusy):
+    return JSONResponse(status_code=503, content={"detail": str(exc)})
 
 
-def get_s3_image(uri: str):
-    img_stream = s3.get_file_stream(uri)
-    return Image.open(img_stream)
+async def prepend_row(first_row: dict, rows):
+    yield first_row
+    async for row in rows:
+        yield row
 
 
 @app.get("/_api/result/csv")
-def result_csv(start: float = None,
-               end: float = None,
-               race: str = None,
-               gender: str = None,
-               min_age: int = None,
-               max_age: int = None,
-               branch: int = None,
-               camera: int = None,
-               min_gender_confidence: float = None,
-               max_gender_confidence: float = None,
-               min_age_confidence: float = None,
-               max_age_confidence: float = None,
-               min_race_confidence: float = None,
-               max_race_confidence: float = None):
+@app.get("/_api/result/export", name="result_export")
+async def result_csv(result_filter: ResultFilter = Depends(),
+                     gzip: bool = False,
+                     format: str = 'csv'):
+    ''' Export the filtered results as csv, ndjson, parquet or arrow (an Arrow IPC stream).
+
+    Parquet and Arrow keep the column types, need pyarrow and are compressed
+    by themselves, gzip only applies to csv and ndjson.
+    '''
 
     # If all param is none, return nothing
-    if all([branch is None, camera is None,
-            max_gender_confidence is None, max_race_confidence is None, max_age_confidence is None,
-            min_gender_confidence is None, min_age_confidence is None, min_race_confidence is None,
-            start is None, end is None,
-            race is None, gender is None, min_age is None, max_age is None]):
+    if result_filter.is_empty():
         raise HTTPException(
             status_code=400, detail="At least one parameter is needed")
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="format must be one of {}".format(', '.join(EXPORT_FORMATS)))
+    if format in ARROW_FORMATS:
+        if gzip:
+            raise HTTPException(status_code=400, detail="gzip only applies to csv and ndjson")
+        if import_pyarrow() is None:
+            raise HTTPException(status_code=501, detail="{} export needs pyarrow, which is not installed".format(format))
 
     # get data from DB
-    connection = pymysql.connect(
-        host=MYSQL_HOST,
-        port=MYSQL_PORT,
-        user=MYSQL_USER,
-        passwd=MYSQL_PASSWORD,
-        db=MYSQL_DB,
-        autocommit=True
-    )
-    rows = None
-    with connection.cursor(cursor=DictCursor) as cursor:
-        query = ("SELECT "
-                 "  FaceImage.id AS ID, "
-                 "  FaceImage.time AS Time, "
-                 "  FaceImage.branch_id AS `Branch ID`, "
-                 "  FaceImage.camera_id AS `Camera ID`, "
-                 "  FaceImage.image_path AS `Image Path`, "
-                 "  Gender.type AS Gender, "
-                 "  Gender.confidence AS `Gender Confidence`, "
-                 "  Age.min_age AS `Min Age`, "
-                 "  Age.max_age AS `Max Age`, "
-                 "  Age.confidence AS `Age Confidence`, "
-                 "  Race.type AS Race, "
-                 "  Race.confidence AS `Race Confidence` "
-                 "FROM FaceImage "
-                 "  INNER JOIN Gender ON FaceImage.id = Gender.face_image_id "
-                 "  INNER JOIN Age ON FaceImage.id = Age.face_image_id "
-                 "  INNER JOIN Race ON FaceImage.id = Race.face_image_id")
-
-        # Add WHERE Clause
-        condition_list = []
-        if start is not None:
-            condition_list.append("FaceImage.time >= %(start)s")
-        if end is not None:
-            condition_list.append("FaceImage.time <= %(end)s")
-        if race is not None:
-            condition_list.append("Race.type like %(race)s")
-        if gender is not None:
-            condition_list.append("Gender.type like %(gender)s")
-        if min_age is not None:
-            condition_list.append("Age.min_age >= %(min_age)s")
-        if max_age is not None:
-            condition_list.append("Age.max_age <= %(max_age)s")
-        if min_gender_confidence is not None:
-            condition_list.append(
-                "Gender.confidence >= %(min_gender_confidence)s")
-        if min_age_confidence is not None:
-            condition_list.append(
-                "Gender.confidence <= %(min_age_confidence)s")
-        if min_race_confidence is not None:
-            condition_list.append(
-                "Race.confidence >= %(min_race_confidence)s")
-        if max_gender_confidence is not None:
-            condition_list.append(
-                "Race.confidence <= %(max_gender_confidence)s")
-        if max_age_confidence is not None:
-            condition_list.append("Age.confidence >= %(max_age_confidence)s")
-        if max_race_confidence is not None:
-            condition_list.append("Age.confidence <= %(max_race_confidence)s")
-        if branch is not None:
-            condition_list.append("FaceImage.branch_id = %(branch)s")
-        if camera is not None:
-            condition_list.append("FaceImage.camera_id = %(camera)s")
-        # Convert to string
-        condition_query_str = ""
-        for condition in condition_list:
-            condition_query_str += condition
-            if condition != condition_list[-1]:
-                condition_query_str += " AND "
-        if condition_query_str != "":
-            query += " WHERE " + condition_query_str
-
-        print(query)
-        effected_row = cursor.execute(query, {
-            "start": start,
-            "end": end,
-            "race": "%{}%".format(race),
-            "gender": "%{}%".format(gender),
-            "branch": branch,
-            "camera": camera,
-            "max_age": max_age,
-            "min_age": min_age,
-            "min_gender_confidence": min_gender_confidence,
-            "min_age_confidence": min_age_confidence,
-            "min_race_confidence": min_race_confidence,
-            "max_gender_confidence": max_gender_confidence,
-            "max_age_confidence": max_age_confidence,
-            "max_race_confidence": max_race_confidence
-        })
-        rows = cursor.fetchall()
-    connection.close()
+    query, params = result_csv_query(result_filter)
+    logger.debug("Result CSV query: %s %s", query, params)
+    rows = db.iter_rows(db.pool, query, params)
 
     # Return nothing if rows is empty
-    if not rows:
+    try:
+        first_row = await rows.__anext__()
+    except StopAsyncIteration:
         # return 204 code
         raise HTTPException(status_code=204, detail="Result is empty")
 
-    # Transform to CSV
-    csv_stream = StringIO()
-    csv_writer = csv.DictWriter(csv_stream, fieldnames=list(rows[0].keys()))
-    csv_writer.writeheader()
-    csv_writer.writerows(rows)
-    csv_stream.seek(0)
+    # Encode as rows arrive
+    rows = prepend_row(first_row, rows)
+    if format == 'csv':
+        chunks = iter_csv(rows)
+    elif format == 'ndjson':
+        chunks = iter_ndjson(rows)
+    else:
+        chunks = iter_arrow(rows, RESULT_EXPORT_COLUMNS, format)
+    headers = {}
+    if gzip:
+        chunks = iter_gzip(chunks)
+        headers['Content-Encoding'] = 'gzip'
 
     # Send to response
+    media_type, extension = EXPORT_FORMATS[format]
     time_str = time.strftime("%d_%b_%Y_%H:%M:%S_+0000", time.gmtime())
-    csv_name = "result_{}.csv".format(time_str)
-    return StreamingResponse(csv_stream, media_type='text/csv', headers={'Content-Disposition': 'attachment; filename="{}"'.format(csv_name)})
+    file_name = "result_{}.{}".format(time_str, extension)
+    headers['Content-Disposition'] = 'attachment; filename="{}"'.format(file_name)
+    return StreamingResponse(chunks, media_type=media_type, headers=headers)
+
+
+# Smallest bucket accepted by the stats endpoint, in seconds
+MIN_STATS_INTERVAL = 60
+
+
+async def fetch_result_stats(result_filter: ResultFilter, interval: int, lo: float, hi: float, with_time: bool):
+    ''' Grouped counts of results whose time is in [lo, hi) '''
+    query, params = result_stats_query(result_filter, interval, lo, hi, with_time)
+    async with db.pool.connection() as connection, connection.cursor(DictCursor) as cursor, timed('db_query'):
+        await cursor.execute(query, params)
+        return list(await cursor.fetchall())
+
+
+stats_rollup = StatsRollup(fetch_result_stats)
+
+
+@app.get("/_api/result/stats")
+async def result_stats(result_filter: ResultFilter = Depends(),
+                       interval: int = 3600):
+    ''' Result counts per interval seconds, branch, camera, gender, race and age band.
+
+    Accepts the same filters as /_api/result/csv.
+    '''
+    if interval < MIN_STATS_INTERVAL:
+        raise HTTPException(status_code=400, detail="interval must be at least {} seconds".format(MIN_STATS_INTERVAL))
+    return await stats_rollup.get(result_filter, interval)
+
 
+# Select a face image together with its gender, race and age results
+QUERY_RESULT = ("SELECT FaceImage.id, FaceImage.image_path, FaceImage.camera_id, FaceImage.branch_id, FaceImage.`time`, "
+                "       FaceImage.position_top, FaceImage.position_right, FaceImage.position_bottom, FaceImage.position_left, "
+                "       Gender.face_image_id AS gender_id, Gender.type AS gender_type, Gender.confidence AS gender_confidence, "
+                "       Race.face_image_id AS race_id, Race.type AS race_type, Race.confidence AS race_confidence, "
+                "       Age.face_image_id AS age_id, Age.min_age, Age.max_age, Age.confidence AS age_confidence "
+                "FROM FaceImage "
+                "  LEFT JOIN Gender ON FaceImage.id = Gender.face_image_id "
+                "  LEFT JOIN Race ON FaceImage.id = Race.face_image_id "
+                "  LEFT JOIN Age ON FaceImage.id = Age.face_image_id ")
 
-def get_result(face_image_id=None):
-    connection = pymysql.connect(
-        host=MYSQL_HOST, port=MYSQL_PORT, user=MYSQL_USER, passwd=MYSQL_PASSWORD, db=MYSQL_DB, autocommit=True)
-    with connection.cursor(cursor=DictCursor) as cursor:
+
+def split_result_row(row: dict):
+    ''' Split a QUERY_RESULT row into face_image, gender, race and age rows '''
+    face_image_row = {key: row[key] for key in ('id', 'image_path', 'camera_id', 'branch_id', 'time',
+                                                'position_top', 'position_right', 'position_bottom', 'position_left')}
+    gender_row = {'type': row['gender_type'],
+                  'confidence': row['gender_confidence']} if row['gender_id'] is not None else None
+    race_row = {'type': row['race_type'],
+                'confidence': row['race_confidence']} if row['race_id'] is not None else None
+    age_row = {'min_age': row['min_age'],
+               'max_age': row['max_age'],
+               'confidence': row['age_confidence']} if row['age_id'] is not None else None
+    return face_image_row, gender_row, race_row, age_row
+
+
+async def query_result(face_image_id=None):
+    async with db.pool.connection() as connection, connection.cursor(DictCursor) as cursor, timed('db_query'):
         if face_image_id:
-            query_latest_face_image = ("SELECT id, image_path, camera_id, branch_id, `time`, "
-                                       "       position_top, position_right, position_bottom, position_left "
-                                       "FROM FaceImage "
-                                       "WHERE id=%(face_image_id)s "
-                                       "ORDER BY time DESC "
-                                       "LIMIT 1;")
+            query = QUERY_RESULT + ("WHERE FaceImage.id=%(face_image_id)s "
+                                    "LIMIT 1;")
         else:
-            # Get latest face_image_id
-            query_latest_face_image = ("SELECT id, image_path, camera_id, branch_id, `time`, "
-                                       "       position_top, position_right, position_bottom, position_left "
-                                       "FROM FaceImage "
-                                       "ORDER BY time DESC "
-                                       "LIMIT 1;")
-        cursor.execute(query_latest_face_image, {
-                       'face_image_id': face_image_id})
-        face_image_row = cursor.fetchone()
-
-        # return empty dict to all results if face_image is not found
-        if face_image_row is None:
-            return {}, {}, {}, {}
-
-        # Get face_image_id
-        face_image_id = face_image_row['id']
-
-        # Get Gender Result
-        query_gender = ("SELECT type, confidence "
-                        "FROM Gender "
-                        "WHERE face_image_id=%s;")
-        cursor.execute(query_gender, (face_image_id,))
-        gender_row = cursor.fetchone()
-
-        # Get Race Result
-        query_race = ("SELECT type, confidence "
-                      "FROM Race "
-                      "WHERE face_image_id=%s;")
-        cursor.execute(query_race, (face_image_id,))
-        race_row = cursor.fetchone()
-
-        # Get Age Result
-        query_age = ("SELECT min_age, max_age, confidence "
-                     "FROM Age "
-                     "WHERE face_image_id=%s;")
-        cursor.execute(query_age, (face_image_id,))
-        age_row = cursor.fetchone()
-    connection.close()
-    logger.debug(face_image_row, gender_row, race_row, age_row)
+            # Get latest face_image
+            query = QUERY_RESULT + ("ORDER BY FaceImage.time DESC "
+                                    "LIMIT 1;")
+        await cursor.execute(query, {'face_image_id': face_image_id})
+        row = await cursor.fetchone()
+
+    # return empty dict to all results if face_image is not found
+    if row is None:
+        return {}, {}, {}, {}
+
+    face_image_row, gender_row, race_row, age_row = split_result_row(row)
+    logger.debug("Result of face image %s: gender %s, race %s, age %s",
+                 face_image_row['id'], gender_row, race_row, age_row)
     return face_image_row, gender_row, race_row, age_row
 
 
-@app.get("/_api/result/{face_image_id}")
-def result(face_image_id: str):
-    # Get all rows
-    if face_image_id == 'latest':
-        face_image_result, gender_result, race_result, age_result = get_result()
-    else:
-        face_image_result, gender_result, race_result, age_result = get_result(
-            int(face_image_id))
+# Concurrent lookups of the same face image (or the latest one) share one query
+result_flight = SingleFlight()
 
-    # raise error if face_image is not found
-    if not face_image_result:
-        raise HTTPException(status_code=404, detail="Face image not found")
 
-    # Get image
-    image = get_s3_image(face_image_result['image_path'])
+async def get_result(face_image_id=None):
+    return await result_flight.do(face_image_id, query_result, face_image_id)
 
+
+async def get_results(face_image_ids: List[int]):
+    ''' Return results of many face images in one query, keyed by face_image_id '''
+    async with db.pool.connection() as connection, connection.cursor(DictCursor) as cursor, timed('db_query'):
+        await cursor.execute(QUERY_RESULT + "WHERE FaceImage.id IN %(face_image_ids)s;",
+                             {'face_image_ids': face_image_ids})
+        rows = await cursor.fetchall()
+
+    results = {}
+    for row in rows:
+        # Keep the first row if a result table has many rows of the same face
+        if row['id'] not in results:
+            results[row['id']] = split_result_row(row)
+    return results
+
+
+def result_boxes(face_image_result: dict):
+    ''' Boxes to draw on the face image '''
     # Draw box if all positions are not null
+    boxes = []
     if all([face_image_result['position_left'],
             face_image_result['position_top'],
             face_image_result['position_right'],
             face_image_result['position_bottom']]):
-        image = draw_box(image,
-                         (face_image_result['position_left'],
-                          face_image_result['position_top']),
-                         (face_image_result['position_right'],
-                          face_image_result['position_bottom']),
-                         "")
+        boxes.append((face_image_result['position_left'],
+                      face_image_result['position_top'],
+                      face_image_result['position_right'],
+                      face_image_result['position_bottom']))
+    return boxes
+
+
+async def build_result(face_image_result: dict, gender_result: dict, race_result: dict, age_result: dict,
+                       inline: bool = True, options: RenderOptions = RenderOptions()):
+    ''' Create response of one face image from its rows.
+
+    The rendered image is inlined as a data URI unless inline is False, in
+    which case clients fetch it from photo_url.
+    '''
+    photo_data_uri = None
+    if inline:
+        image = await get_image(face_image_result['image_path'], result_boxes(face_image_result), options)
+        photo_data_uri = bytes_to_data_uri(image, options.media_type)
 
     # Insert one result
+    gender_result = gender_result or {'type': None, 'confidence': None}
+    race_result = race_result or {'type': None, 'confidence': None}
+    age_result = age_result or {'min_age': None, 'max_age': None, 'confidence': None}
     results = [{
         'gender': {
             'type': gender_result['type'],
@@ -296,10 +319,154 @@ def result(face_image_id: str):
             'branch_id': face_image_result['branch_id'],
             'camera_id': face_image_result['camera_id'],
             'results': results,
-            'photo_data_uri': image_to_data_uri(image)}
+            'photo_data_uri': photo_data_uri,
+            'photo_url': '/_api/result/{}/image{}'.format(face_image_result['id'], render_options_query(options))}
+
+
+# Latest face image and which of its results have landed, rows of Gender, Race and Age
+# arrive after the face image
+QUERY_LATEST_RESULT_MARKER = ("SELECT FaceImage.id, Gender.face_image_id, Race.face_image_id, Age.face_image_id "
+                              "FROM FaceImage "
+                              "  LEFT JOIN Gender ON FaceImage.id = Gender.face_image_id "
+                              "  LEFT JOIN Race ON FaceImage.id = Race.face_image_id "
+                              "  LEFT JOIN Age ON FaceImage.id = Age.face_image_id "
+                              "ORDER BY FaceImage.time DESC LIMIT 1;")
+
+
+async def fetch_latest_result_marker():
+    async with db.pool.connection() as connection, connection.cursor() as cursor, timed('db_query'):
+        await cursor.execute(QUERY_LATEST_RESULT_MARKER)
+        row = await cursor.fetchone()
+    return tuple(row) if row is not None else None
+
+
+async def build_result_event(marker: tuple):
+    ''' Payload of the live feed, the image is referenced by URL to keep events small '''
+    face_image_id = marker[0]
+    return await build_result(*(await get_result(face_image_id)), inline=False)
+
+
+# A result landing for the latest face image changes the marker as well as a new face image
+result_feed = LiveFeed('result', fetch_latest_result_marker, build_result_event)
+
+
+@app.get("/_api/result/live")
+async def result_live():
+    ''' Server-Sent Events of the latest result, pushed whenever it or its results change '''
+    return StreamingResponse(result_feed.subscribe(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.get("/_api/result")
+async def result_batch(ids: str, inline: bool = True,
+                       options: RenderOptions = Depends(parse_render_options)):
+    ''' Return results of comma-separated face image ids, in the same order '''
+    try:
+        face_image_ids = [int(face_image_id) for face_image_id in ids.split(',') if face_image_id.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids must be comma-separated integers")
+    if not face_image_ids:
+        raise HTTPException(status_code=400, detail="At least one id is needed")
+    if len(face_image_ids) > RESULT_BATCH_MAX_IDS:
+        raise HTTPException(status_code=400, detail="At most {} ids are allowed".format(RESULT_BATCH_MAX_IDS))
+
+    results = await get_results(face_image_ids)
+    semaphore = asyncio.Semaphore(RESULT_BATCH_CONCURRENCY)
+
+    async def build(face_image_id):
+        async with semaphore:
+            try:
+                return await build_result(*results[face_image_id], inline=inline, options=options)
+            except Exception as exc:
+                # One missing or unrenderable image does not fail the whole batch
+                return {'id': face_image_id, 'error': str(exc)}
+
+    # Skip face images that are not found, render the others a few at a time
+    return await asyncio.gather(*(build(face_image_id)
+                                  for face_image_id in face_image_ids if face_image_id in results))
+
+
+async def get_result_or_404(face_image_id: str):
+    # Get all rows
+    if face_image_id == 'latest':
+        rows = await get_result()
+    else:
+        rows = await get_result(int(face_image_id))
+
+    # raise error if face_image is not found
+    if not rows[0]:
+        raise HTTPException(status_code=404, detail="Face image not found")
+    return rows
+
+
+@app.get("/_api/result/{face_image_id}/image")
+async def result_image(face_image_id: str, request: Request,
+                       options: RenderOptions = Depends(parse_render_options)):
+    ''' Rendered image of the face image, with ETag and Range support '''
+    face_image_result = (await get_result_or_404(face_image_id))[0]
+    boxes = result_boxes(face_image_result)
+
+    # Answer revalidation before touching S3
+    etag = make_etag(*image_cache_key(face_image_result['image_path'], boxes, options))
+    cacheable = face_image_id != 'latest'
+    if is_not_modified(request, etag):
+        return not_modified_response(etag, cacheable)
+
+    image = await get_image(face_image_result['image_path'], boxes, options)
+    return binary_response(request, image, etag, media_type=options.media_type, cacheable=cacheable)
+
+
+@app.get("/_api/result/{face_image_id}")
+async def result(face_image_id: str, inline: bool = True,
+                 options: RenderOptions = Depends(parse_render_options)):
+    face_image_result, gender_result, race_result, age_result = await get_result_or_404(face_image_id)
+    return await build_result(face_image_result, gender_result, race_result, age_result,
+                              inline=inline, options=options)
+
+
+def collect_stats():
+    return {'db': {'default': db.pool.stats(),
+                   'face_recognition': db.pool_fade.stats()},
+            'image_cache': image_cache.stats(),
+            'faces': routes.images.face_cache.stats(),
+            'render': render_pool.stats(),
+            'result_stats': stats_rollup.stats(),
+            'live': {'result': result_feed.stats(),
+                     'image': routes.images.image_feed.stats()},
+            'singleflight': {'result': result_flight.stats(),
+                             'image': routes.images.image_flight.stats(),
+                             's3': s3.flight.stats(),
+                             'render': render_flight.stats()},
+            'startup': startup.stats()}
+
+
+register_stats(collect_stats)
+
+
+@app.get('/_api/stats')
+async def stats():
+    return collect_stats()
+
+
+@app.get('/metrics')
+def metrics():
+    ''' Prometheus metrics: request and stage latency histograms, and /_api/stats as gauges '''
+    return metrics_response()
 
 
 # For check with probe in openshift
 @app.get('/healthz')
 def health_check():
     return
+
+
+@app.get('/healthz/live')
+def liveness():
+    ''' The worker is up and answering '''
+    return {'status': 'ok'}
+
+
+@app.get('/healthz/ready')
+def readiness():
+    ''' Ready once connections are open and render workers are warm, 503 until then '''
+    return JSONResponse(status_code=200 if startup.ready else 503, content=startup.stats())
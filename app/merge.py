@@ -0,0 +1,214 @@
+import asyncio
+from collections import OrderedDict
+from typing import Dict, List
+
+from app.config import FACE_CACHE_MAX_IMAGES
+from app.metrics import timed
+
+POSITIONS = ("position_top", "position_right", "position_bottom", "position_left")
+
+
+def _overlap(face: dict, result: dict, iou_threshold: float) -> bool:
+    ''' Whether result overlaps face enough to be the same face '''
+    left = max(face["position_left"], result["position_left"])
+    right = min(face["position_right"], result["position_right"])
+    top = max(face["position_top"], result["position_top"])
+    bottom = min(face["position_bottom"], result["position_bottom"])
+    if not (left < right and top < bottom):
+        return False
+    if iou_threshold <= 0:
+        return True
+
+    intersect_area = (right - left) * (bottom - top)
+    face_area = (face["position_right"] - face["position_left"]) * (face["position_bottom"] - face["position_top"])
+    result_area = (result["position_right"] - result["position_left"]) * (result["position_bottom"] - result["position_top"])
+    return intersect_area / (face_area + result_area - intersect_area) >= iou_threshold
+
+
+class FaceMerger:
+    ''' Merge results of many tables into faces using a uniform grid index.
+
+    A result joins the first face (in creation order) that overlaps it with
+    IoU >= iou_threshold, a threshold of 0 meaning any overlap. Only faces
+    registered in the grid cells covered by the result are compared.
+    '''
+
+    def __init__(self, iou_threshold: float = 0.0, cell_size: int = 128, faces: List[dict] = None):
+        self.iou_threshold = iou_threshold
+        self.cell_size = cell_size
+        self.faces = []
+        # (column, row) of cell -> indices of faces covering it
+        self._grid = {}
+        # face index -> cells it is registered in
+        self._face_cells = []
+
+        for face in faces or []:
+            self.faces.append(dict(face))
+            self._face_cells.append(set())
+            self._register(len(self.faces) - 1)
+
+    def _cells(self, box: dict):
+        cell_size = self.cell_size
+        for column in range(int(box["position_left"] // cell_size), int(box["position_right"] // cell_size) + 1):
+            for row in range(int(box["position_top"] // cell_size), int(box["position_bottom"] // cell_size) + 1):
+                yield column, row
+
+    def _register(self, face_index: int):
+        # Boxes only grow, so cells are only ever added
+        registered = self._face_cells[face_index]
+        for cell in self._cells(self.faces[face_index]):
+            if cell not in registered:
+                registered.add(cell)
+                self._grid.setdefault(cell, []).append(face_index)
+
+    def _find(self, result: dict):
+        candidates = set()
+        for cell in self._cells(result):
+            candidates.update(self._grid.get(cell, ()))
+        for face_index in sorted(candidates):
+            if _overlap(self.faces[face_index], result, self.iou_threshold):
+                return face_index
+        return None
+
+    def add(self, result: dict, column_names: List[str]):
+        ''' Merge one result row, copying column_names into its face '''
+        face_index = self._find(result)
+
+        if face_index is not None:
+            # Update face position to the exist face
+            face = self.faces[face_index]
+            face["position_top"] = min(face["position_top"], result["position_top"])
+            face["position_right"] = max(face["position_right"], result["position_right"])
+            face["position_bottom"] = max(face["position_bottom"], result["position_bottom"])
+            face["position_left"] = min(face["position_left"], result["position_left"])
+        else:
+            # Create new face
+            face = {position: result[position] for position in POSITIONS}
+            self.faces.append(face)
+            self._face_cells.append(set())
+            face_index = len(self.faces) - 1
+
+        # Add each column
+        for column_name in column_names:
+            face[column_name] = result[column_name]
+        self._register(face_index)
+
+
+def merge_faces(fetch_result: Dict[str, List[dict]], table_column_name: Dict[str, List[str]],
+                iou_threshold: float = 0.0, cell_size: int = 128) -> List[dict]:
+    ''' Create faces from the results of each table '''
+    merger = FaceMerger(iou_threshold, cell_size)
+    for table, result_list in fetch_result.items():
+        for result in result_list:
+            merger.add(result, table_column_name[table])
+    return merger.faces
+
+
+class _CachedImage:
+    ''' Result rows of one image and the faces merged from them '''
+
+    def __init__(self, stamps: Dict[str, object], rows: Dict[str, List[dict]]):
+        # table -> stage timestamp of the rows, for the tables that have landed
+        self.stamps = stamps
+        self.rows = rows
+        self.iou_threshold = None
+        self.faces = None
+
+
+class FaceCache:
+    ''' Merged faces of recently viewed images, kept up to date with the stage timestamps.
+
+    fetch(image, table) must return the result rows of one table for the
+    image row. The image row tells when each stage landed, so an image whose
+    timestamps are unchanged is served without touching the result tables and
+    a newly landed stage only fetches its own table. When that table comes
+    after every cached one in table_column_name order, its rows are merged
+    into the cached faces, which is what a full merge would do. Otherwise the
+    faces are re-merged from the cached rows.
+
+    Faces are kept for the last iou_threshold asked for each image.
+    '''
+
+    def __init__(self, fetch, table_column_name: Dict[str, List[str]], cell_size: int = 128,
+                 max_images: int = FACE_CACHE_MAX_IMAGES):
+        self.fetch = fetch
+        self.table_column_name = table_column_name
+        self.cell_size = cell_size
+        self.max_images = max_images
+
+        # image id -> _CachedImage, least recently used first
+        self._images = OrderedDict()
+
+        # Metrics
+        self._hits = 0
+        self._merged = 0
+        self._remerged = 0
+        self._misses = 0
+        self._tables_fetched = 0
+
+    def _store(self, image_id, cached: _CachedImage):
+        self._images[image_id] = cached
+        self._images.move_to_end(image_id)
+        while len(self._images) > self.max_images:
+            self._images.popitem(last=False)
+
+    def _merge(self, faces, rows: Dict[str, List[dict]], iou_threshold: float) -> List[dict]:
+        merger = FaceMerger(iou_threshold, self.cell_size, faces)
+        with timed('merge'):
+            for table, result_list in rows.items():
+                for result in result_list:
+                    merger.add(result, self.table_column_name[table])
+        return merger.faces
+
+    async def get(self, image: dict, iou_threshold: float) -> List[dict]:
+        ''' Faces of the image row, the caller may modify them '''
+        tables = list(self.table_column_name)
+        stamps = {table: image[f'{table}_timestamp'] for table in tables
+                  if image[f'{table}_timestamp'] is not None}
+        cached = self._images.get(image['id'])
+        miss = cached is None
+        if miss:
+            self._misses += 1
+            cached = _CachedImage({}, {})
+
+        changed = [table for table in stamps if cached.stamps.get(table) != stamps[table]]
+        if changed or len(stamps) != len(cached.stamps):
+            fetched = await asyncio.gather(*(self.fetch(image, table) for table in changed))
+            self._tables_fetched += len(changed)
+            rows = dict(cached.rows, **dict(zip(changed, fetched)))
+            updated = _CachedImage(stamps, {table: rows[table] for table in stamps})
+
+            # Landed stages that all come after the cached ones extend the cached faces
+            last_cached = max((tables.index(table) for table in cached.stamps), default=-1)
+            if (cached.faces is not None and cached.iou_threshold == iou_threshold
+                    and set(cached.stamps) <= set(stamps)
+                    and all(table not in cached.stamps and tables.index(table) > last_cached
+                            for table in changed)):
+                self._merged += 1
+                updated.faces = self._merge(cached.faces, {table: updated.rows[table] for table in changed},
+                                            iou_threshold)
+            else:
+                if cached.stamps:
+                    self._remerged += 1
+                updated.faces = self._merge(None, updated.rows, iou_threshold)
+            updated.iou_threshold = iou_threshold
+            cached = updated
+        elif cached.iou_threshold != iou_threshold:
+            if not miss:
+                self._remerged += 1
+            cached.faces = self._merge(None, cached.rows, iou_threshold)
+            cached.iou_threshold = iou_threshold
+        else:
+            self._hits += 1
+
+        self._store(image['id'], cached)
+        return [dict(face) for face in cached.faces]
+
+    def stats(self):
+        return {'images': len(self._images),
+                'max_images': self.max_images,
+                'hits': self._hits,
+                'merged': self._merged,
+                'remerged': self._remerged,
+                'misses': self._misses,
+                'tables_fetched': self._tables_fetched}
@@ -0,0 +1,210 @@
+import contextvars
+import time
+from typing import Callable, List, Optional, Tuple
+
+from prometheus_client import (CollectorRegistry, Histogram, REGISTRY, CONTENT_TYPE_LATEST,
+                               generate_latest, multiprocess)
+from prometheus_client.core import GaugeMetricFamily
+from starlette.responses import Response
+from starlette.routing import NoMatchFound
+
+from app.config import SERVER_TIMING, PROMETHEUS_MULTIPROC_DIR
+
+REQUEST_SECONDS = Histogram('http_request_duration_seconds', "Time spent serving HTTP requests",
+                            ['method', 'route', 'status'])
+STAGE_SECONDS = Histogram('stage_duration_seconds', "Time spent in each stage of a request",
+                          ['stage'],
+                          buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+
+# (stage, seconds) spans of the current request, None outside of a request
+_spans = contextvars.ContextVar('spans', default=None)  # type: contextvars.ContextVar[Optional[list]]
+# Whether spans are only collected, to be observed by the parent process
+_deferred = contextvars.ContextVar('deferred', default=False)
+
+
+def record(stage: str, seconds: float):
+    ''' Observe a stage duration and add it to the spans of the current request '''
+    if not _deferred.get():
+        STAGE_SECONDS.labels(stage).observe(seconds)
+    spans = _spans.get()
+    if spans is not None:
+        spans.append((stage, seconds))
+
+
+class timed:
+    ''' Time a with or async with block as one span of stage '''
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.stage, time.perf_counter() - self.started)
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, *exc_info):
+        self.__exit__(*exc_info)
+
+
+def _collect(fn, args):
+    _deferred.set(True)
+    spans = []
+    _spans.set(spans)
+    return fn(*args), spans
+
+
+def collect_spans(fn, *args) -> Tuple[object, List[Tuple[str, float]]]:
+    ''' Return fn(*args) and the spans it recorded, without observing them.
+
+    Render workers use it so their timings are observed in the process that
+    serves /metrics and counted in the Server-Timing of the request.
+    '''
+    return contextvars.copy_context().run(_collect, fn, args)
+
+
+def use_spans(spans: Optional[list]):
+    ''' Collect the spans of the current task into spans, or drop them with None.
+
+    Tasks inherit the spans of the request that started them, background and
+    shared tasks call it first so they do not add to that request only.
+    '''
+    _spans.set(spans)
+
+
+def add_spans(spans: List[Tuple[str, float]]):
+    ''' Add spans already observed elsewhere to the current request '''
+    current = _spans.get()
+    if current is not None:
+        current.extend(spans)
+
+
+def server_timing(spans: List[Tuple[str, float]], total: float) -> str:
+    ''' Server-Timing header value, durations of the same stage are summed '''
+    durations = {}
+    for stage, seconds in spans:
+        durations[stage] = durations.get(stage, 0.0) + seconds
+    durations['total'] = total
+    return ', '.join('{};dur={:.2f}'.format(stage, seconds * 1000) for stage, seconds in durations.items())
+
+
+# (route name, route path) -> full route template
+_templates = {}
+
+
+def _template(scope: dict, route) -> str:
+    # route.path lacks the prefix of an included router, ask the app for the full path
+    # of the route with each parameter filled in with its own placeholder
+    key = (route.name, route.path)
+    template = _templates.get(key)
+    if template is None:
+        params = getattr(route, 'param_convertors', {})
+        try:
+            template = scope['app'].url_path_for(route.name, **{name: '{' + name + '}' for name in params})
+        except (NoMatchFound, AssertionError, ValueError):
+            # e.g. a convertor refusing the placeholder
+            template = route.path
+        # Another route of the same name was found first
+        if not template.endswith(route.path):
+            template = route.path
+        _templates[key] = template
+    return template
+
+
+def _route(scope: dict) -> str:
+    # Label by route template rather than path to keep the cardinality bounded
+    route = scope.get('route')
+    if route is not None:
+        return _template(scope, route)
+    endpoint = scope.get('endpoint')
+    return endpoint.__name__ if endpoint is not None else 'unmatched'
+
+
+class TimingMiddleware:
+    ''' Observe the latency of every HTTP request and collect its stage spans.
+
+    The Server-Timing header is added when the request carries an
+    X-Server-Timing header, or to every response if SERVER_TIMING is set. For
+    streaming responses it only covers the stages done before the first byte.
+    '''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        spans = []
+        token = _spans.set(spans)
+        add_header = SERVER_TIMING or any(name == b'x-server-timing' for name, _ in scope['headers'])
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                if add_header:
+                    value = server_timing(spans, time.perf_counter() - started)
+                    message = dict(message, headers=list(message.get('headers', [])) +
+                                   [(b'server-timing', value.encode('latin-1'))])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _spans.reset(token)
+            REQUEST_SECONDS.labels(scope['method'], _route(scope), status).observe(time.perf_counter() - started)
+
+
+def _gauges(prefix: str, stats: dict):
+    for key, value in stats.items():
+        name = f'{prefix}_{key}'
+        if isinstance(value, dict):
+            yield from _gauges(name, value)
+        elif isinstance(value, (int, float)):
+            yield GaugeMetricFamily(name, f"{key} from /_api/stats", value=value)
+
+
+class StatsCollector:
+    ''' Expose the numbers of a stats() style dict as gauges, read at scrape time '''
+
+    def __init__(self, stats: Callable[[], dict], prefix: str = 'app'):
+        self.stats = stats
+        self.prefix = prefix
+
+    def collect(self):
+        return _gauges(self.prefix, self.stats())
+
+
+_collectors = []
+
+
+def register_stats(stats: Callable[[], dict]):
+    ''' Publish stats() on /metrics '''
+    collector = StatsCollector(stats)
+    _collectors.append(collector)
+    if not PROMETHEUS_MULTIPROC_DIR:
+        REGISTRY.register(collector)
+
+
+def metrics_response() -> Response:
+    ''' Prometheus exposition of the histograms and registered stats.
+
+    With PROMETHEUS_MULTIPROC_DIR set, histograms of every worker process are
+    aggregated; the stats gauges are those of the worker serving the scrape.
+    '''
+    registry = REGISTRY
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        for collector in _collectors:
+            registry.register(collector)
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,204 @@
+import math
+from typing import Dict, List, NamedTuple, Tuple
+
+
+class Filter(NamedTuple):
+    ''' A query parameter compared against one column '''
+    param: str
+    column: str
+    operator: str
+
+
+class Query:
+    ''' Small SELECT builder keeping SQL fragments and their parameters together '''
+
+    def __init__(self, select: str, from_: str):
+        self.select = select
+        self.from_ = from_
+        self.conditions = []
+        self.params = {}
+        self.group_by = None
+        self.order_by = None
+        self.limit = None
+
+    def where(self, condition: str, **params) -> 'Query':
+        self.conditions.append(condition)
+        self.params.update(params)
+        return self
+
+    def filter(self, filters: List[Filter], values: Dict[str, object], exclude: Tuple[str, ...] = ()) -> 'Query':
+        ''' Add a condition for each filter whose value is not None '''
+        for query_filter in filters:
+            value = values.get(query_filter.param)
+            if value is None or query_filter.param in exclude:
+                continue
+            self.where(f"{query_filter.column} {query_filter.operator} %({query_filter.param})s",
+                       **{query_filter.param: value})
+        return self
+
+    def time_range(self, column: str, lo: float, hi: float) -> 'Query':
+        ''' Keep rows with lo <= column < hi, infinite bounds are left out '''
+        if lo != -math.inf:
+            self.where(f"{column} >= %(range_lo)s", range_lo=lo)
+        if hi != math.inf:
+            self.where(f"{column} < %(range_hi)s", range_hi=hi)
+        return self
+
+    def sql(self) -> Tuple[str, dict]:
+        query = f"SELECT {self.select} FROM {self.from_}"
+        if self.conditions:
+            query += " WHERE " + " AND ".join(self.conditions)
+        if self.group_by:
+            query += f" GROUP BY {self.group_by}"
+        if self.order_by:
+            query += f" ORDER BY {self.order_by}"
+        if self.limit is not None:
+            query += " LIMIT %(limit)s"
+        return query, dict(self.params, **({'limit': self.limit} if self.limit is not None else {}))
+
+
+# Filters of the joined FaceImage, Gender, Age and Race results. Gender and
+# race are enum-like columns and use exact matches so their indexes can be used.
+RESULT_FILTERS = [
+    Filter('start', 'FaceImage.time', '>='),
+    Filter('end', 'FaceImage.time', '<='),
+    Filter('branch', 'FaceImage.branch_id', '='),
+    Filter('camera', 'FaceImage.camera_id', '='),
+    Filter('gender', 'Gender.type', '='),
+    Filter('race', 'Race.type', '='),
+    Filter('min_age', 'Age.min_age', '>='),
+    Filter('max_age', 'Age.max_age', '<='),
+    Filter('min_gender_confidence', 'Gender.confidence', '>='),
+    Filter('max_gender_confidence', 'Gender.confidence', '<='),
+    Filter('min_age_confidence', 'Age.confidence', '>='),
+    Filter('max_age_confidence', 'Age.confidence', '<='),
+    Filter('min_race_confidence', 'Race.confidence', '>='),
+    Filter('max_race_confidence', 'Race.confidence', '<='),
+]
+
+RESULT_JOIN = ("FaceImage "
+               "  INNER JOIN Gender ON FaceImage.id = Gender.face_image_id "
+               "  INNER JOIN Age ON FaceImage.id = Age.face_image_id "
+               "  INNER JOIN Race ON FaceImage.id = Race.face_image_id")
+
+
+class ResultFilter:
+    ''' Query parameters filtering the results, shared by the result endpoints '''
+
+    def __init__(self,
+                 start: float = None,
+                 end: float = None,
+                 race: str = None,
+                 gender: str = None,
+                 min_age: int = None,
+                 max_age: int = None,
+                 branch: int = None,
+                 camera: int = None,
+                 min_gender_confidence: float = None,
+                 max_gender_confidence: float = None,
+                 min_age_confidence: float = None,
+                 max_age_confidence: float = None,
+                 min_race_confidence: float = None,
+                 max_race_confidence: float = None):
+        self.start = start
+        self.end = end
+        self.race = race
+        self.gender = gender
+        self.min_age = min_age
+        self.max_age = max_age
+        self.branch = branch
+        self.camera = camera
+        self.min_gender_confidence = min_gender_confidence
+        self.max_gender_confidence = max_gender_confidence
+        self.min_age_confidence = min_age_confidence
+        self.max_age_confidence = max_age_confidence
+        self.min_race_confidence = min_race_confidence
+        self.max_race_confidence = max_race_confidence
+
+    def is_empty(self):
+        return all(value is None for value in vars(self).values())
+
+    def key(self):
+        ''' Hashable identity of the filters other than start and end '''
+        return tuple((name, value) for name, value in sorted(vars(self).items())
+                     if name not in ('start', 'end'))
+
+
+# Columns of the result export and their Arrow types
+RESULT_EXPORT_COLUMNS = [('ID', 'int64'),
+                         ('Time', 'double'),
+                         ('Branch ID', 'int64'),
+                         ('Camera ID', 'int64'),
+                         ('Image Path', 'string'),
+                         ('Gender', 'string'),
+                         ('Gender Confidence', 'double'),
+                         ('Min Age', 'int64'),
+                         ('Max Age', 'int64'),
+                         ('Age Confidence', 'double'),
+                         ('Race', 'string'),
+                         ('Race Confidence', 'double')]
+
+
+def result_csv_query(result_filter: ResultFilter) -> Tuple[str, dict]:
+    ''' Rows of the result export, with the columns of RESULT_EXPORT_COLUMNS '''
+    query = Query("FaceImage.id AS ID, "
+                  "FaceImage.time AS Time, "
+                  "FaceImage.branch_id AS `Branch ID`, "
+                  "FaceImage.camera_id AS `Camera ID`, "
+                  "FaceImage.image_path AS `Image Path`, "
+                  "Gender.type AS Gender, "
+                  "Gender.confidence AS `Gender Confidence`, "
+                  "Age.min_age AS `Min Age`, "
+                  "Age.max_age AS `Max Age`, "
+                  "Age.confidence AS `Age Confidence`, "
+                  "Race.type AS Race, "
+                  "Race.confidence AS `Race Confidence`",
+                  RESULT_JOIN)
+    return query.filter(RESULT_FILTERS, vars(result_filter)).sql()
+
+
+def result_stats_query(result_filter: ResultFilter, interval: int,
+                       lo: float = -math.inf, hi: float = math.inf, with_time: bool = True) -> Tuple[str, dict]:
+    ''' Counts per bucket of interval seconds, branch, camera, gender, race and age band,
+    of results whose time is in [lo, hi) '''
+    query = Query("FLOOR(FaceImage.time / %(interval)s) * %(interval)s AS bucket, "
+                  "FaceImage.branch_id, "
+                  "FaceImage.camera_id, "
+                  "Gender.type AS gender, "
+                  "Race.type AS race, "
+                  "Age.min_age, "
+                  "Age.max_age, "
+                  "COUNT(*) AS count",
+                  RESULT_JOIN)
+    query.params['interval'] = interval
+    query.filter(RESULT_FILTERS, vars(result_filter), exclude=() if with_time else ('start', 'end'))
+    query.time_range('FaceImage.time', lo, hi)
+    query.group_by = "bucket, FaceImage.branch_id, FaceImage.camera_id, gender, race, Age.min_age, Age.max_age"
+    return query.sql()
+
+
+# Filters of the image listing
+IMAGE_FILTERS = [
+    Filter('since', 'timestamp', '>='),
+    Filter('until', 'timestamp', '<='),
+]
+
+
+def image_list_query(since: float = None, until: float = None, cursor: tuple = None,
+                     limit: int = 100) -> Tuple[str, dict]:
+    ''' A page of images, newest first, after the (timestamp, id) keyset cursor '''
+    query = Query("id, path, timestamp", "image")
+    query.filter(IMAGE_FILTERS, {'since': since, 'until': until})
+    if cursor is not None:
+        # Keyset on (timestamp, id), both descending
+        query.where("(timestamp < %(cursor_timestamp)s OR "
+                    "(timestamp = %(cursor_timestamp)s AND id < %(cursor_id)s))",
+                    cursor_timestamp=cursor[0], cursor_id=cursor[1])
+    query.order_by = "timestamp DESC, id DESC"
+    query.limit = limit
+    return query.sql()
+
+
+def image_ids_query(image_ids: List[int]) -> Tuple[str, dict]:
+    ''' Images of the given ids '''
+    return Query("id, path, timestamp", "image").where("id IN %(image_ids)s", image_ids=image_ids).sql()
@@ -0,0 +1,175 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import urlencode
+
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+
+from app import s3
+from app.cache import image_cache, image_cache_key
+from app.metrics import collect_spans, record, timed
+from app.singleflight import SingleFlight
+from app.config import RENDER_WORKERS, RENDER_QUEUE_DEPTH, RENDER_TIMEOUT
+from app.utils import is_format_supported, is_passthrough, render_image, RenderOptions, IMAGE_FORMATS
+
+
+class RenderBusy(Exception):
+    ''' Raised when the render queue is full or a render takes too long '''
+
+
+def _warm():
+    # Import the image libraries so the first render of the worker does not pay for it
+    from PIL import Image, JpegImagePlugin  # noqa: F401
+
+
+class RenderPool:
+    ''' Run CPU-bound image work (decode, draw, encode) in worker processes.
+
+    At most queue_depth renders may be waiting or running at once, further
+    renders are rejected with RenderBusy instead of piling up. A render that
+    times out keeps its place until its worker is done with it.
+
+    When a worker process dies (e.g. killed for memory) the pool is replaced
+    and the renders it was running fail with RenderBusy.
+    '''
+
+    def __init__(self, workers: int, queue_depth: int, timeout: float):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.timeout = timeout
+        self._executor = None
+
+        # Metrics
+        self._pending = 0
+        self._completed = 0
+        self._rejected = 0
+        self._timeouts = 0
+        self._restarts = 0
+
+    async def start(self):
+        ''' Start the worker processes and wait until each one is up '''
+        if self.workers <= 0 or self._executor is not None:
+            return
+        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self._executor, _warm)
+                               for _ in range(self.workers)))
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _restart(self, broken: ProcessPoolExecutor):
+        # Concurrent renders of the broken pool all fail, only the first replaces it
+        if self._executor is not broken:
+            return
+        broken.shutdown(wait=False)
+        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        self._restarts += 1
+
+    def _submit(self, fn, *args) -> asyncio.Future:
+        if self._executor is None:
+            return asyncio.ensure_future(run_in_threadpool(collect_spans, fn, *args))
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self._executor, collect_spans, fn, *args)
+
+    def _done(self, future: asyncio.Future):
+        self._pending -= 1
+        # Mark the exception as retrieved in case the caller timed out
+        if not future.cancelled():
+            future.exception()
+
+    async def run(self, fn, *args):
+        ''' Return fn(*args) computed in a worker process, fn must be picklable.
+
+        Spans timed inside fn are sent back with its result and recorded here.
+        '''
+        if self._pending >= self.queue_depth:
+            self._rejected += 1
+            raise RenderBusy("Too many images are being rendered")
+
+        executor = self._executor
+        try:
+            with timed('render'):
+                future = self._submit(fn, *args)
+                self._pending += 1
+                future.add_done_callback(self._done)
+                # Shielded so a timeout does not free the slot of a render still running
+                result, spans = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            self._timeouts += 1
+            raise RenderBusy("Rendering the image took too long")
+        except BrokenProcessPool:
+            self._restart(executor)
+            raise RenderBusy("A render process exited, the image could not be rendered")
+        self._completed += 1
+        for stage, seconds in spans:
+            record(stage, seconds)
+        return result
+
+    def stats(self):
+        return {'workers': self.workers,
+                'queue_depth': self.queue_depth,
+                'pending': self._pending,
+                'completed': self._completed,
+                'rejected': self._rejected,
+                'timeouts': self._timeouts,
+                'restarts': self._restarts}
+
+
+render_pool = RenderPool(RENDER_WORKERS, RENDER_QUEUE_DEPTH, RENDER_TIMEOUT)
+
+
+# Named widths accepted by the size query parameter
+SIZES = {'thumbnail': 160, 'small': 320, 'medium': 640, 'large': 1280}
+
+
+def parse_render_options(size: str = None, max_width: int = None,
+                         quality: int = None, format: str = 'jpeg') -> RenderOptions:
+    ''' Validate query parameters describing an image variant '''
+    if size is not None:
+        if size not in SIZES:
+            raise HTTPException(400, f"size must be one of {', '.join(SIZES)}")
+        max_width = SIZES[size] if max_width is None else min(max_width, SIZES[size])
+    if max_width is not None and max_width <= 0:
+        raise HTTPException(400, "max_width must be positive")
+    if quality is not None and not 1 <= quality <= 95:
+        raise HTTPException(400, "quality must be between 1 and 95")
+    if format not in IMAGE_FORMATS:
+        raise HTTPException(400, f"format must be one of {', '.join(IMAGE_FORMATS)}")
+    if not is_format_supported(format):
+        raise HTTPException(400, f"format {format} is not supported by this server")
+    return RenderOptions(max_width, quality, format)
+
+
+def render_options_query(options: RenderOptions) -> str:
+    ''' Query string selecting the same variant, empty for the default one '''
+    query = {name: value for name, value in options._asdict().items()
+             if value != RenderOptions._field_defaults[name]}
+    return '?' + urlencode(query) if query else ''
+
+
+# Concurrent cache misses of the same variant share one download and render
+render_flight = SingleFlight()
+
+
+async def _render(path: str, boxes: list, options: RenderOptions, cache_key) -> bytes:
+    data = await s3.get_file_bytes(path)
+    # Skip the round trip to a render process when the object is sent as is
+    if is_passthrough(data, boxes, options):
+        image = data
+    else:
+        image = await render_pool.run(render_image, data, boxes, options)
+    await image_cache.put(cache_key, image)
+    return image
+
+
+async def get_image(path: str, boxes: list, options: RenderOptions = RenderOptions()) -> bytes:
+    ''' Return the variant of S3 image path with boxes drawn, from cache or rendered '''
+    cache_key = image_cache_key(path, boxes, options)
+    image = await image_cache.get(cache_key)
+    if image is None:
+        image = await render_flight.do(cache_key, _render, path, boxes, options, cache_key)
+    return image
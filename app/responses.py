@@ -0,0 +1,81 @@
+import hashlib
+import re
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+from app.config import IMAGE_MAX_AGE
+
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def make_etag(*parts) -> str:
+    ''' Strong ETag derived from everything that determines the content '''
+    return '"{}"'.format(hashlib.sha1(repr(parts).encode('utf-8')).hexdigest())
+
+
+def _opaque_tag(tag: str) -> str:
+    tag = tag.strip()
+    return tag[2:] if tag.startswith('W/') else tag
+
+
+def is_not_modified(request: Request, etag: str) -> bool:
+    ''' Whether If-None-Match of request already matches etag, using the weak comparison it requires '''
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is None:
+        return False
+    tags = [_opaque_tag(tag) for tag in if_none_match.split(',')]
+    return '*' in tags or _opaque_tag(etag) in tags
+
+
+def not_modified_response(etag: str, cacheable: bool) -> Response:
+    return Response(status_code=304, headers=_cache_headers(etag, cacheable))
+
+
+def _cache_headers(etag: str, cacheable: bool) -> dict:
+    return {'ETag': etag,
+            'Accept-Ranges': 'bytes',
+            # Content of "latest" changes, so it must always be revalidated
+            'Cache-Control': f'public, max-age={IMAGE_MAX_AGE}' if cacheable else 'no-cache'}
+
+
+def _parse_range(range_header: str, size: int):
+    ''' Return (start, end) inclusive of a single byte range, None to send everything '''
+    match = RANGE_PATTERN.match(range_header.strip())
+    if match is None:
+        # Multiple or malformed ranges, ignore the header
+        return None
+    first, last = match.groups()
+    if first == '' and last == '':
+        return None
+    if first == '':
+        # Suffix range: the last N bytes
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    return start, end
+
+
+def binary_response(request: Request, content: bytes, etag: str,
+                    media_type: str = 'image/jpeg', cacheable: bool = True) -> Response:
+    ''' Response of content honouring If-None-Match and a single byte Range '''
+    headers = _cache_headers(etag, cacheable)
+    if is_not_modified(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get('range')
+    if_range = request.headers.get('if-range')
+    if range_header is None or (if_range is not None and if_range != etag):
+        return Response(content, media_type=media_type, headers=headers)
+
+    byte_range = _parse_range(range_header, len(content))
+    if byte_range is None:
+        return Response(content, media_type=media_type, headers=headers)
+    start, end = byte_range
+    if start > end or start >= len(content):
+        headers['Content-Range'] = f'bytes */{len(content)}'
+        return Response(status_code=416, headers=headers)
+
+    headers['Content-Range'] = f'bytes {start}-{end}/{len(content)}'
+    return Response(content[start:end + 1], status_code=206, media_type=media_type, headers=headers)
@@ -1,10 +1,26 @@
-from fastapi import APIRouter, HTTPException
-import pymysql
-from PIL import Image
-
-from app.config import MYSQL_CONFIG_FADE
-from app.s3 import get_file_stream
-from app.utils import image_to_data_uri, draw_box, find_intersect_area
+import asyncio
+import base64
+import json
+
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.encoders import jsonable_encoder
+from starlette.responses import StreamingResponse
+import aiomysql
+
+from app.config import (IMAGES_PAGE_SIZE, IMAGES_MAX_PAGE_SIZE,
+                        FACE_MERGE_IOU_THRESHOLD, FACE_MERGE_CELL_SIZE, FACE_CROP_PADDING,
+                        IMAGES_BULK_MAX_IDS, IMAGES_BULK_CONCURRENCY)
+from app.db import pool_fade
+from app import s3
+from app.utils import bytes_to_data_uri, crop_faces, RenderOptions
+from app.cache import image_cache_key
+from app.merge import FaceCache
+from app.singleflight import SingleFlight
+from app.live import LiveFeed
+from app.metrics import timed
+from app.query import image_list_query, image_ids_query
+from app.render import get_image, parse_render_options, render_options_query, render_pool
+from app.responses import make_etag, is_not_modified, not_modified_response, binary_response
 
 router = APIRouter()
 
@@ -29,141 +45,258 @@ TABLE_COLUMN_NAME = {'age': ["0_to_10_confidence",
                  'face_recognition': ['label']}
 
 
-def fetch_image(image_id: str, cnx: pymysql.connections.Connection):
+async def fetch_image(image_id: str, cnx: aiomysql.Connection):
     image_id = image_id if image_id != "latest" else None
     # Get DictCursor
-    with cnx.cursor(cursor=pymysql.cursors.DictCursor) as cursor:
-        cursor.execute("SELECT id, path, timestamp, gender_timestamp, age_timestamp, emotion_timestamp, face_recognition_timestamp "
-                       "FROM image "
-                       "WHERE id=COALESCE(%(image_id)s,id) "
-                       "ORDER BY timestamp DESC "
-                       "LIMIT 1;", {'image_id': image_id})
-        image_row = cursor.fetchone()
+    async with cnx.cursor(aiomysql.DictCursor) as cursor, timed('db_query'):
+        await cursor.execute("SELECT id, path, timestamp, gender_timestamp, age_timestamp, emotion_timestamp, face_recognition_timestamp "
+                             "FROM image "
+                             "WHERE id=COALESCE(%(image_id)s,id) "
+                             "ORDER BY timestamp DESC "
+                             "LIMIT 1;", {'image_id': image_id})
+        image_row = await cursor.fetchone()
     return image_row
 
 
-@router.get('/{image_id}/faces')
-def read_all_faces_image(image_id: str):
-    # Connect to database
-    sql_connection = pymysql.connect(**MYSQL_CONFIG_FADE)
+async def fetch_table_result(image: dict, table_result: str):
+    ''' Fetch the results of one stage table for the image '''
+    table_column_list = TABLE_COLUMN_NAME[table_result]
+    async with pool_fade.connection() as sql_connection, \
+            sql_connection.cursor(aiomysql.DictCursor) as cursor, timed('db_query'):
+        await cursor.execute(f"SELECT id, position_top, position_right, position_bottom, position_left, {', '.join(table_column_list)} "
+                             f"FROM {table_result} "
+                             "WHERE image_id=%(image_id)s "
+                             "ORDER BY timestamp;",
+                             {'image_id': image['id']})
+        return await cursor.fetchall()
+
+
+async def load_image(image_id: str):
+    async with pool_fade.connection() as sql_connection:
+        return await fetch_image(image_id, sql_connection)
+
+
+# Concurrent lookups of the same image id (or "latest") share one query
+image_flight = SingleFlight()
 
-    image = fetch_image(image_id, sql_connection)
+
+async def fetch_image_or_404(image_id: str):
+    # Fetch image by ID
+    image = await image_flight.do(image_id, load_image, image_id)
 
     # Check if the latest image is exist
     if image is None:
         raise HTTPException(404, "Image not found")
+    return image
+
+
+# Result rows are fetched only for the stages that landed since the image was
+# last seen, each table concurrently on its own connection
+face_cache = FaceCache(fetch_table_result, TABLE_COLUMN_NAME, FACE_MERGE_CELL_SIZE)
+
 
-    with sql_connection.cursor(cursor=pymysql.cursors.DictCursor) as cursor:
-
-        # Fetch results from each tables
-        fetch_result = {}
-        for table_result, table_column_list in TABLE_COLUMN_NAME.items():
-
-            # Skip this table if result is not inserted
-            if image[f'{table_result}_timestamp'] is None:
-                continue
-
-            # Fetch result from database
-            cursor.execute(f"SELECT id, position_top, position_right, position_bottom, position_left, {', '.join(table_column_list)} "
-                           f"FROM {table_result} "
-                           "WHERE image_id=%(image_id)s "
-                           "ORDER BY timestamp;",
-                           {'image_id': image['id']})
-            fetch_result[table_result] = cursor.fetchall()
-
-    # Close database connection
-    sql_connection.close()
-
-    # Create faces from all fetched results
-    faces = []
-    # Iterate through each table
-    for table, result_list in fetch_result.items():
-        # Iterate through each result in that table
-        for result in result_list:
-            # Find the exist face
-            face_index_to_update = None
-            for face_index, face in enumerate(faces):
-                # Calculate intersection area
-                area = find_intersect_area({'top': face['position_top'],
-                                            'right': face['position_right'],
-                                            'bottom': face['position_bottom'],
-                                            'left': face['position_left']},
-                                           {'top': result['position_top'],
-                                            'right': result['position_right'],
-                                            'bottom': result['position_bottom'],
-                                            'left': result['position_left']})
-
-                # condition to update the exist face
-                # condition: if the intersection between face and result is exist
-                # TODO: use a better condition
-                if area is not None:
-                    face_index_to_update = face_index
-                    break
-
-            if face_index_to_update is not None:
-                # Update face position to the exist face
-                faces[face_index_to_update]["position_top"] = min(faces[face_index_to_update]["position_top"], result["position_top"])
-                faces[face_index_to_update]["position_right"] = max(faces[face_index_to_update]["position_right"], result["position_right"])
-                faces[face_index_to_update]["position_bottom"] = max(faces[face_index_to_update]["position_bottom"], result["position_bottom"])
-                faces[face_index_to_update]["position_left"] = min(faces[face_index_to_update]["position_left"], result["position_left"])
-
-                # Add each column
-                for column_name in TABLE_COLUMN_NAME[table]:
-                    faces[face_index_to_update][column_name] = result[column_name]
-            else:
-                # Create new face
-                faces.append({})
-
-                # Add face position
-                for position in ("position_top", "position_right", "position_bottom", "position_left"):
-                    faces[-1][position] = result[position]
-
-                # Add each column
-                for column_name in TABLE_COLUMN_NAME[table]:
-                    faces[-1][column_name] = result[column_name]
+async def get_faces(image: dict, iou_threshold: float):
+    return await face_cache.get(image, iou_threshold)
+
+
+async def fetch_latest_image():
+    return await image_flight.do("latest", load_image, "latest")
+
+
+async def build_image_event(image: dict):
+    ''' Payload of the live feed: the latest image and its merged faces '''
+    return {'id': image['id'],
+            'path': image['path'],
+            'timestamp': image['timestamp'],
+            'image_url': f"/_api/images/{image['id']}/raw",
+            'faces': await get_faces(image, FACE_MERGE_IOU_THRESHOLD)}
+
+
+# The image row carries the timestamp of every stage, so a new stage result
+# changes the marker as well as a new image
+image_feed = LiveFeed('image', fetch_latest_image, build_image_event)
+
+
+@router.get('/live')
+async def read_images_live():
+    ''' Server-Sent Events of the latest image, pushed whenever it or its results change '''
+    return StreamingResponse(image_feed.subscribe(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+async def bulk_image_lines(image_ids: list, images: dict, options: RenderOptions):
+    ''' Yield one JSON line per image id, in the order their downloads finish '''
+    semaphore = asyncio.Semaphore(IMAGES_BULK_CONCURRENCY)
+
+    async def render(image_id):
+        image = images.get(image_id)
+        if image is None:
+            return {'id': image_id, 'error': "Image not found"}
+        async with semaphore:
+            try:
+                content = await get_image(image['path'], [], options)
+            except Exception as exc:
+                return {'id': image_id, 'error': str(exc)}
+        return {'id': image['id'],
+                'path': image['path'],
+                'timestamp': image['timestamp'],
+                'data_uri': bytes_to_data_uri(content, options.media_type)}
+
+    tasks = [asyncio.ensure_future(render(image_id)) for image_id in image_ids]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield json.dumps(jsonable_encoder(await task)) + '\n'
+    finally:
+        # Stop the remaining downloads if the client goes away
+        for task in tasks:
+            task.cancel()
+
+
+@router.get('/bulk')
+async def read_images_bulk(ids: str, options: RenderOptions = Depends(parse_render_options)):
+    ''' Stream images of comma-separated ids as JSON lines, as soon as each one is ready '''
+    try:
+        image_ids = list(dict.fromkeys(int(image_id) for image_id in ids.split(',') if image_id.strip()))
+    except ValueError:
+        raise HTTPException(400, "ids must be comma-separated integers")
+    if not image_ids:
+        raise HTTPException(400, "At least one id is needed")
+    if len(image_ids) > IMAGES_BULK_MAX_IDS:
+        raise HTTPException(400, f"At most {IMAGES_BULK_MAX_IDS} ids are allowed")
+
+    # Resolve every path with one query
+    query, params = image_ids_query(image_ids)
+    async with pool_fade.connection() as sql_connection, \
+            sql_connection.cursor(aiomysql.DictCursor) as cursor, timed('db_query'):
+        await cursor.execute(query, params)
+        images = {image['id']: image for image in await cursor.fetchall()}
+
+    return StreamingResponse(bulk_image_lines(image_ids, images, options), media_type='application/x-ndjson')
+
+
+@router.get('/{image_id}/faces')
+async def read_all_faces_image(image_id: str, iou_threshold: float = FACE_MERGE_IOU_THRESHOLD):
+    image = await fetch_image_or_404(image_id)
+    return await get_faces(image, iou_threshold)
 
+
+@router.get('/{image_id}/faces/crops')
+async def read_all_faces_crops(image_id: str,
+                               iou_threshold: float = FACE_MERGE_IOU_THRESHOLD,
+                               padding: float = FACE_CROP_PADDING,
+                               options: RenderOptions = Depends(parse_render_options)):
+    ''' Merged faces of the image, each with a crop of its region as data URI '''
+    if padding < 0:
+        raise HTTPException(400, "padding must not be negative")
+
+    image = await fetch_image_or_404(image_id)
+
+    # Download the frame while the results are merged
+    faces, data = await asyncio.gather(get_faces(image, iou_threshold), s3.get_file_bytes(image["path"]))
+
+    # Decode the frame once and cut every face from it
+    boxes = [(face['position_left'], face['position_top'], face['position_right'], face['position_bottom'])
+             for face in faces]
+    crops = await render_pool.run(crop_faces, data, boxes, padding, options) if boxes else []
+
+    for face, crop in zip(faces, crops):
+        face['crop_data_uri'] = bytes_to_data_uri(crop, options.media_type) if crop is not None else None
     return faces
 
 
-@router.get("/{image_id}")
-def read_image(image_id: str):
-    ''' return image and data of the latest image '''
-    # Connect to database
-    sql_connection = pymysql.connect(**MYSQL_CONFIG_FADE)
+@router.get("/{image_id}/raw")
+async def read_image_raw(image_id: str, request: Request,
+                         options: RenderOptions = Depends(parse_render_options)):
+    ''' Encoded image, with ETag and Range support '''
+    image = await fetch_image_or_404(image_id)
 
-    # Fetch image by ID
-    image = fetch_image(image_id, sql_connection)
+    # Answer revalidation before touching S3
+    etag = make_etag(*image_cache_key(image["path"], [], options))
+    cacheable = image_id != "latest"
+    if is_not_modified(request, etag):
+        return not_modified_response(etag, cacheable)
 
-    # Check if the latest image is exist
-    if image is None:
-        sql_connection.close()
-        raise HTTPException(404, "Image not found")
+    content = await get_image(image["path"], [], options)
+    return binary_response(request, content, etag, media_type=options.media_type, cacheable=cacheable)
 
-    # Close database connection
-    sql_connection.close()
 
-    # Get image from S3
-    image["Image"] = Image.open(get_file_stream(image["path"]))
+@router.get("/{image_id}")
+async def read_image(image_id: str, inline: bool = True,
+                     options: RenderOptions = Depends(parse_render_options)):
+    ''' return image and data of the latest image.
+
+    The image is inlined as a data URI unless inline is False, in which case
+    clients fetch it from image_url.
+    '''
+    image = await fetch_image_or_404(image_id)
+
+    data_uri = None
+    if inline:
+        data_uri = bytes_to_data_uri(await get_image(image["path"], [], options), options.media_type)
 
     return {'id': image['id'],
             'path': image['path'],
             'timestamp': image['timestamp'],
-            'data_uri': image_to_data_uri(image["Image"])}
+            'data_uri': data_uri,
+            'image_url': f"/_api/images/{image['id']}/raw{render_options_query(options)}"}
 
 
-@router.get("/")
-def read_all_images():
-    ''' Return all images '''
-    # Connect to database
-    sql_connection = pymysql.connect(**MYSQL_CONFIG_FADE)
+def encode_cursor(row: dict) -> str:
+    ''' Encode the position after row as an opaque cursor '''
+    position = json.dumps(jsonable_encoder([row['timestamp'], row['id']]))
+    return base64.urlsafe_b64encode(position.encode('utf-8')).decode('ascii')
+
 
-    with sql_connection.cursor(cursor=pymysql.cursors.DictCursor) as cursor:
-        cursor.execute("SELECT id, path, timestamp "
-                       "FROM image "
-                       "ORDER BY timestamp DESC ")
-        images = cursor.fetchall()
+def decode_cursor(cursor: str):
+    ''' Return (timestamp, id) from a cursor made by encode_cursor '''
+    try:
+        timestamp, image_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError):
+        raise HTTPException(400, "Invalid cursor")
+    return timestamp, image_id
 
-    # Close database connection
-    sql_connection.close()
 
-    return images if images is not None else []
+def iter_json_array(rows: list):
+    yield '['
+    for index, row in enumerate(rows):
+        yield (',' if index else '') + json.dumps(jsonable_encoder(row))
+    yield ']'
+
+
+def iter_json_lines(rows: list):
+    for row in rows:
+        yield json.dumps(jsonable_encoder(row)) + '\n'
+
+
+@router.get("/")
+async def read_all_images(limit: int = IMAGES_PAGE_SIZE,
+                          since: float = None,
+                          until: float = None,
+                          cursor: str = None,
+                          format: str = 'json'):
+    ''' Return a page of images, newest first.
+
+    The cursor of the next page is sent in the X-Next-Cursor header.
+    '''
+    if not 0 < limit <= IMAGES_MAX_PAGE_SIZE:
+        raise HTTPException(400, f"limit must be between 1 and {IMAGES_MAX_PAGE_SIZE}")
+    if format not in ('json', 'ndjson'):
+        raise HTTPException(400, "format must be json or ndjson")
+
+    # One extra row tells whether there is a next page
+    query, params = image_list_query(since, until,
+                                     decode_cursor(cursor) if cursor is not None else None,
+                                     limit + 1)
+    async with pool_fade.connection() as sql_connection, \
+            sql_connection.cursor(aiomysql.DictCursor) as db_cursor, timed('db_query'):
+        await db_cursor.execute(query, params)
+        images = list(await db_cursor.fetchall())
+
+    headers = {}
+    if len(images) > limit:
+        images = images[:limit]
+        headers['X-Next-Cursor'] = encode_cursor(images[-1])
+
+    if format == 'ndjson':
+        return StreamingResponse(iter_json_lines(images), media_type='application/x-ndjson', headers=headers)
+    return StreamingResponse(iter_json_array(images), media_type='application/json', headers=headers)
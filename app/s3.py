@@ -1,54 +1,97 @@
-import io
-import os
-
-import boto3
-from botocore import UNSIGNED
-from botocore.client import Config
-
-# Environment variables
-S3_ENDPOINT = os.environ['S3_ENDPOINT']
-S3_ACCESS_KEY = os.environ['S3_ACCESS_KEY']
-S3_SECRET_KEY = os.environ['S3_SECRET_KEY']
-
-
-def get_file_stream(uri):
-    # split bucket & key
-    BUCKET_NAME, filename = split_s3_bucket_key(uri)
-
-    s3 = boto3.resource('s3',
-                        endpoint_url=S3_ENDPOINT,
-                        aws_access_key_id=S3_ACCESS_KEY,
-                        aws_secret_access_key=S3_SECRET_KEY,
-                        config=Config(signature_version='s3v4'))
-    img_bucket = s3.Bucket(BUCKET_NAME)
-    img_obj = img_bucket.Object(filename)
-
-    # Prepare stream
-    file_stream = io.BytesIO()
-    img_obj.download_fileobj(file_stream)
-
-    return file_stream
-
-
-def find_bucket_key(s3_path):
-    """
-    This is a helper function that given an s3 path such that the path is of
-    the form: bucket/key
-    It will return the bucket and the key represented by the s3 path
-    """
-    s3_components = s3_path.split('/')
-    bucket = s3_components[0]
-    s3_key = ""
-    if len(s3_components) > 1:
-        s3_key = '/'.join(s3_components[1:])
-    return bucket, s3_key
-
-
-def split_s3_bucket_key(s3_path):
-    """Split s3 path into bucket and key prefix.
-    This will also handle the s3:// prefix.
-    :return: Tuple of ('bucketname', 'keyname')
-    """
-    if s3_path.startswith('s3://'):
-        s3_path = s3_path[5:]
-    return find_bucket_key(s3_path)
+import asyncio
+
+from app.metrics import timed
+from app.singleflight import SingleFlight
+from app.config import (S3_ENDPOINT, S3_ACCESS_KEY, S3_SECRET_KEY,
+                        S3_MAX_POOL_CONNECTIONS, S3_MAX_ATTEMPTS)
+
+_client = None
+_client_context = None
+_client_lock = None
+
+# Concurrent downloads of the same object share one request
+flight = SingleFlight()
+
+
+async def open_client():
+    ''' Create the process-wide S3 client if it does not exist yet '''
+    global _client, _client_context, _client_lock
+    if _client_lock is None:
+        _client_lock = asyncio.Lock()
+    async with _client_lock:
+        if _client is None:
+            # aiobotocore takes a while to import, only pay for it when a client is made
+            from aiobotocore.config import AioConfig
+            from aiobotocore.session import get_session
+
+            _client_context = get_session().create_client(
+                's3',
+                endpoint_url=S3_ENDPOINT,
+                aws_access_key_id=S3_ACCESS_KEY,
+                aws_secret_access_key=S3_SECRET_KEY,
+                config=AioConfig(signature_version='s3v4',
+                                 max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                                 retries={'max_attempts': S3_MAX_ATTEMPTS,
+                                          'mode': 'standard'}))
+            _client = await _client_context.__aenter__()
+    return _client
+
+
+async def close_client():
+    ''' Close the S3 client and its connection pool '''
+    global _client, _client_context
+    if _client_context is not None:
+        await _client_context.__aexit__(None, None, None)
+    _client = None
+    _client_context = None
+
+
+async def get_client():
+    ''' Return the process-wide S3 client, creating it on first use '''
+    return _client if _client is not None else await open_client()
+
+
+async def _get_object(uri: str, byte_range: str = None):
+    # split bucket & key
+    bucket_name, key = split_s3_bucket_key(uri)
+    kwargs = {'Bucket': bucket_name, 'Key': key}
+    if byte_range is not None:
+        kwargs['Range'] = byte_range
+    client = await get_client()
+    return await client.get_object(**kwargs)
+
+
+async def _download(uri: str, byte_range: str = None) -> bytes:
+    with timed('s3_download'):
+        response = await _get_object(uri, byte_range)
+        async with response['Body'] as body:
+            return await body.read()
+
+
+async def get_file_bytes(uri: str, byte_range: str = None) -> bytes:
+    ''' Return the object content, or only byte_range (e.g. "bytes=0-1023") of it '''
+    return await flight.do((uri, byte_range), _download, uri, byte_range)
+
+
+def find_bucket_key(s3_path):
+    """
+    This is a helper function that given an s3 path such that the path is of
+    the form: bucket/key
+    It will return the bucket and the key represented by the s3 path
+    """
+    s3_components = s3_path.split('/')
+    bucket = s3_components[0]
+    s3_key = ""
+    if len(s3_components) > 1:
+        s3_key = '/'.join(s3_components[1:])
+    return bucket, s3_key
+
+
+def split_s3_bucket_key(s3_path):
+    """Split s3 path into bucket and key prefix.
+    This will also handle the s3:// prefix.
+    :return: Tuple of ('bucketname', 'keyname')
+    """
+    if s3_path.startswith('s3://'):
+        s3_path = s3_path[5:]
+    return find_bucket_key(s3_path)
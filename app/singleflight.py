@@ -0,0 +1,87 @@
+import asyncio
+from collections import OrderedDict
+
+from app.config import SINGLEFLIGHT_MAX_KEYS
+from app.metrics import add_spans, use_spans
+
+# Keys listed by stats(), most coalesced first
+STATS_TOP_KEYS = 20
+
+
+class SingleFlight:
+    ''' Share one in-flight call between concurrent callers of the same key.
+
+    Nothing is kept once the call completes: a caller arriving afterwards
+    starts a new call, so coalescing never serves stale results. The call
+    runs in its own task, a caller that is cancelled (e.g. its client went
+    away) does not cancel it for the others. Callers share the result object
+    and must not modify it. The spans timed by the call are added to the
+    Server-Timing of every caller.
+
+    Counters of the max_keys most recently used keys are kept for stats().
+    '''
+
+    def __init__(self, max_keys: int = SINGLEFLIGHT_MAX_KEYS):
+        self.max_keys = max_keys
+
+        # key -> task of the call in flight
+        self._tasks = {}
+        # task -> spans recorded by the call, added to the Server-Timing of every caller
+        self._spans = {}
+        # key -> [calls, shared], least recently used first
+        self._counters = OrderedDict()
+
+        # Metrics
+        self._calls = 0
+        self._shared = 0
+
+    def _count(self, key, shared: bool):
+        counters = self._counters.get(key)
+        if counters is None:
+            counters = self._counters[key] = [0, 0]
+            while len(self._counters) > self.max_keys:
+                self._counters.popitem(last=False)
+        else:
+            self._counters.move_to_end(key)
+        counters[0] += 1
+        self._calls += 1
+        if shared:
+            counters[1] += 1
+            self._shared += 1
+
+    @staticmethod
+    async def _call(spans: list, fn, *args):
+        use_spans(spans)
+        return await fn(*args)
+
+    def _done(self, key, task: asyncio.Future):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        self._spans.pop(task, None)
+        # Mark the exception as retrieved in case every caller was cancelled
+        if not task.cancelled():
+            task.exception()
+
+    async def do(self, key, fn, *args):
+        ''' Return await fn(*args), or the result of the identical call already in flight '''
+        task = self._tasks.get(key)
+        self._count(key, shared=task is not None)
+        if task is None:
+            spans = []
+            task = self._tasks[key] = asyncio.ensure_future(self._call(spans, fn, *args))
+            self._spans[task] = spans
+            task.add_done_callback(lambda done: self._done(key, done))
+        spans = self._spans[task]
+        try:
+            return await asyncio.shield(task)
+        finally:
+            add_spans(spans)
+
+    def stats(self):
+        top_keys = sorted(self._counters.items(), key=lambda item: item[1][1], reverse=True)[:STATS_TOP_KEYS]
+        return {'calls': self._calls,
+                'shared': self._shared,
+                'in_flight': len(self._tasks),
+                'keys': len(self._counters),
+                'top_keys': [{'key': str(key), 'calls': calls, 'shared': shared}
+                             for key, (calls, shared) in top_keys]}
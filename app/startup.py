@@ -0,0 +1,35 @@
+import logging
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger("api")
+
+
+class StartupReport:
+    ''' Time of each startup step, and whether the worker is ready to serve '''
+
+    def __init__(self):
+        self.steps = {}
+        self.ready = False
+        self.error = None
+        self.attempts = 0
+
+    @contextmanager
+    def step(self, name: str):
+        ''' Time the block, steps re-run by a retry keep the time of their first success '''
+        started = time.perf_counter()
+        yield
+        self.steps.setdefault(name, time.perf_counter() - started)
+
+    def log(self):
+        logger.info("Startup: %s", ', '.join('{} {:.0f} ms'.format(name, seconds * 1000)
+                                             for name, seconds in self.steps.items()))
+
+    def stats(self):
+        return {'ready': self.ready,
+                'attempts': self.attempts,
+                'error': self.error,
+                'steps': self.steps}
+
+
+startup = StartupReport()
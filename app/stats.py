@@ -0,0 +1,117 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict
+
+from app.config import STATS_GRACE, STATS_CACHE_MAX_KEYS
+
+
+class _Rollup:
+    ''' Counts of the closed buckets in [lo, hi) of one filter combination '''
+
+    def __init__(self, lo: float, hi: float):
+        self.lo = lo
+        self.hi = hi
+        # bucket -> rows of that bucket
+        self.buckets = {}
+
+    def add(self, rows: list):
+        for row in rows:
+            self.buckets.setdefault(row['bucket'], []).append(row)
+
+
+class StatsRollup:
+    ''' In-memory materialized counts of closed time buckets.
+
+    fetch(filters, interval, lo, hi, with_time) must return the grouped rows
+    whose time is in [lo, hi) (either bound may be infinite), also applying the
+    start and end filters when with_time is True. Buckets that ended more than
+    grace seconds ago never change again, so they are fetched once per filter
+    combination and interval and served from memory afterwards. Only the
+    still-open buckets and partially covered edge buckets are queried on every
+    request.
+    '''
+
+    def __init__(self, fetch, grace: float = STATS_GRACE, max_keys: int = STATS_CACHE_MAX_KEYS):
+        self.fetch = fetch
+        self.grace = grace
+        self.max_keys = max_keys
+
+        # (filters key, interval) -> _Rollup, least recently used first
+        self._rollups = OrderedDict()
+        self._locks = {}
+
+        # Metrics
+        self._cached_buckets_served = 0
+        self._range_queries = 0
+
+    def _get_lock(self, key):
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        return lock
+
+    def _store(self, key, rollup: _Rollup):
+        self._rollups[key] = rollup
+        self._rollups.move_to_end(key)
+        while len(self._rollups) > self.max_keys:
+            evicted_key, _ = self._rollups.popitem(last=False)
+            self._locks.pop(evicted_key, None)
+
+    async def _fetch_range(self, filters, interval: int, lo: float, hi: float, with_time: bool):
+        self._range_queries += 1
+        rows = await self.fetch(filters, interval, lo, hi, with_time)
+        for row in rows:
+            row['bucket'] = float(row['bucket'])
+        return rows
+
+    async def _closed_rows(self, filters, interval: int, lo: float, hi: float):
+        ''' Rows of closed buckets in [lo, hi), filling the rollup where it lacks them '''
+        key = (filters.key(), interval)
+        async with self._get_lock(key):
+            rollup = self._rollups.get(key)
+
+            # Start over if the cached range cannot be extended contiguously
+            if rollup is None or lo > rollup.hi or hi < rollup.lo:
+                rollup = _Rollup(lo, hi)
+                rollup.add(await self._fetch_range(filters, interval, lo, hi, False))
+            else:
+                if lo < rollup.lo:
+                    rollup.add(await self._fetch_range(filters, interval, lo, rollup.lo, False))
+                    rollup.lo = lo
+                if hi > rollup.hi:
+                    rollup.add(await self._fetch_range(filters, interval, rollup.hi, hi, False))
+                    rollup.hi = hi
+            self._store(key, rollup)
+
+            buckets = [bucket for bucket in rollup.buckets if lo <= bucket < hi]
+            self._cached_buckets_served += len(buckets)
+            return [row for bucket in buckets for row in rollup.buckets[bucket]]
+
+    async def get(self, filters, interval: int):
+        ''' Return counts per bucket of interval seconds, ordered by bucket '''
+        # Buckets fully inside [start, end] and closed can be cached
+        lo = math.ceil(filters.start / interval) * interval if filters.start is not None else -math.inf
+        hi = math.floor(filters.end / interval) * interval if filters.end is not None else math.inf
+        hi = min(hi, math.floor((time.time() - self.grace) / interval) * interval)
+
+        if lo >= hi:
+            rows = await self._fetch_range(filters, interval, -math.inf, math.inf, True)
+        else:
+            # Everything before lo and from hi on is queried live
+            closed_rows, before_rows, after_rows = await asyncio.gather(
+                self._closed_rows(filters, interval, lo, hi),
+                self._fetch_range(filters, interval, -math.inf, lo, True) if lo != -math.inf else _no_rows(),
+                self._fetch_range(filters, interval, hi, math.inf, True))
+            rows = before_rows + closed_rows + after_rows
+        return sorted(rows, key=lambda row: row['bucket'])
+
+    def stats(self):
+        return {'rollups': len(self._rollups),
+                'cached_buckets': sum(len(rollup.buckets) for rollup in self._rollups.values()),
+                'cached_buckets_served': self._cached_buckets_served,
+                'range_queries': self._range_queries}
+
+
+async def _no_rows():
+    return []
@@ -1,30 +1,181 @@
 import base64
-from PIL import Image, ImageDraw, ImageFont
-from io import BytesIO
-from typing import Tuple
+import csv
+import functools
+import zlib
+from io import BytesIO, StringIO
+from typing import Tuple, List, AsyncIterable, AsyncIterator, NamedTuple, Optional, TYPE_CHECKING
 
+from app.config import JPEG_QUALITY, JPEG_PROGRESSIVE, JPEG_OPTIMIZE, JPEG_KEEP_QUANTIZATION
+from app.metrics import timed
 
-def image_to_data_uri(img: Image.Image):
-    ''' Convert PILLOW image to data URI '''
+# PIL is imported where it is first used, which keeps it out of the import of the app
+if TYPE_CHECKING:
+    from PIL import Image
+
+# PIL format and media type of each output format
+IMAGE_FORMATS = {'jpeg': ('JPEG', 'image/jpeg'),
+                 'webp': ('WEBP', 'image/webp')}
+
+JPEG_MAGIC = b'\xff\xd8\xff'
+
+
+@functools.lru_cache(maxsize=None)
+def is_format_supported(format: str) -> bool:
+    ''' Whether the installed Pillow can encode format, WebP needs Pillow built with libwebp '''
+    if format == 'webp':
+        from PIL import features
+        return features.check('webp')
+    return True
+
+
+class RenderOptions(NamedTuple):
+    ''' Variant of a rendered image '''
+    max_width: Optional[int] = None
+    quality: Optional[int] = None
+    format: str = 'jpeg'
+
+    @property
+    def media_type(self):
+        return IMAGE_FORMATS[self.format][1]
+
+
+def encoder_settings() -> tuple:
+    ''' JPEG_* settings changing the bytes of a re-encoded image, part of every variant key '''
+    return JPEG_QUALITY, JPEG_PROGRESSIVE, JPEG_OPTIMIZE, JPEG_KEEP_QUANTIZATION
+
+
+def is_passthrough(data: bytes, boxes: list, options: RenderOptions) -> bool:
+    ''' Whether the source bytes are already the requested variant and can be sent as they are '''
+    return not boxes and options == RenderOptions() and data.startswith(JPEG_MAGIC)
+
+
+def save_options(options: RenderOptions, source: 'Image.Image') -> dict:
+    ''' Keyword arguments of Image.save encoding the variant in options.
+
+    source is the decoded image as opened, before any resize, whose JPEG
+    quantization tables may be reused.
+    '''
+    from PIL import JpegImagePlugin
+
+    if options.format != 'jpeg':
+        return {'quality': options.quality} if options.quality is not None else {}
+
+    kwargs = {'progressive': JPEG_PROGRESSIVE, 'optimize': JPEG_OPTIMIZE}
+    if options.quality is not None:
+        kwargs['quality'] = options.quality
+    elif JPEG_KEEP_QUANTIZATION and getattr(source, 'quantization', None):
+        kwargs['qtables'] = source.quantization
+        kwargs['subsampling'] = JpegImagePlugin.get_sampling(source)
+    else:
+        kwargs['quality'] = JPEG_QUALITY
+    return kwargs
+
+
+def image_to_jpeg(img: 'Image.Image') -> bytes:
+    ''' Encode PILLOW image to JPEG bytes '''
     buffered = BytesIO()
     img.save(buffered, 'JPEG')
-    img_base64 = base64.b64encode(buffered.getvalue())
-    data_uri_byte = bytes("data:image/jpeg;base64,",
-                          encoding='utf-8') + img_base64
-    data_uri_string = data_uri_byte.decode('utf-8')
+    return buffered.getvalue()
+
+
+def bytes_to_data_uri(data: bytes, media_type: str):
+    ''' Convert encoded image bytes to data URI '''
+    with timed('base64'):
+        img_base64 = base64.b64encode(data)
+        data_uri_byte = bytes("data:{};base64,".format(media_type),
+                              encoding='utf-8') + img_base64
+        data_uri_string = data_uri_byte.decode('utf-8')
     return data_uri_string
 
 
-def draw_box(img: Image.Image, lt_corner: Tuple[int], rb_corner: Tuple[int], title: str):
-    draw = ImageDraw.Draw(img)
-    draw.rectangle([lt_corner, rb_corner], outline="red", width=2)
+def jpeg_to_data_uri(jpeg: bytes):
+    ''' Convert JPEG bytes to data URI '''
+    return bytes_to_data_uri(jpeg, 'image/jpeg')
+
+
+def image_to_data_uri(img: 'Image.Image'):
+    ''' Convert PILLOW image to data URI '''
+    return jpeg_to_data_uri(image_to_jpeg(img))
+
+
+def render_image(data: bytes, boxes: List[Tuple[int, int, int, int]],
+                 options: RenderOptions = RenderOptions()) -> bytes:
+    ''' Decode image bytes, draw (left, top, right, bottom) boxes and encode the variant in options.
+
+    Box coordinates are in the original resolution and are scaled along with the image.
+    '''
+    from PIL import Image, ImageDraw
+
+    source = Image.open(BytesIO(data))
+    width, height = source.size
+    needs_resize = bool(options.max_width) and width > options.max_width
+
+    # Nothing to draw, resize or re-encode: keep the original bytes
+    if (not boxes and not needs_resize and options.quality is None
+            and options.format == 'jpeg' and source.format == 'JPEG'):
+        return data
+
+    with timed('decode'):
+        # Let the JPEG decoder skip full-size decoding through draft() when downscaling
+        scale = 1.0
+        if needs_resize:
+            scale = options.max_width / width
+            size = (options.max_width, max(1, round(height * scale)))
+            source.draft(source.mode, size)
+        source.load()
+    img = source
+
+    if scale != 1.0:
+        with timed('resize'):
+            img = img.resize(size, Image.BILINEAR)
 
-    # text_size according to the size of box
-    text_size = int((rb_corner[1] - lt_corner[1]) * 0.04 * 4)
+    if boxes:
+        with timed('draw'):
+            draw = ImageDraw.Draw(img)
+            for left, top, right, bottom in boxes:
+                draw.rectangle([(left * scale, top * scale), (right * scale, bottom * scale)], outline="red", width=2)
+
+    with timed('encode'):
+        buffered = BytesIO()
+        img.save(buffered, IMAGE_FORMATS[options.format][0], **save_options(options, source))
+    return buffered.getvalue()
+
+
+def crop_faces(data: bytes, boxes: List[Tuple[int, int, int, int]], padding: float = 0.0,
+               options: RenderOptions = RenderOptions()) -> List[Optional[bytes]]:
+    ''' Decode image bytes once and encode the (left, top, right, bottom) region of each box.
+
+    Each box is grown by padding times its width and height on every side,
+    clipped to the image. A box that is empty once clipped gives None.
+    '''
+    from PIL import Image
+
+    with timed('decode'):
+        img = Image.open(BytesIO(data))
+        img.load()
+    width, height = img.size
+    crop_save_options = save_options(options, img)
+
+    crops = []
+    for left, top, right, bottom in boxes:
+        pad_x = (right - left) * padding
+        pad_y = (bottom - top) * padding
+        region = (max(0, int(left - pad_x)), max(0, int(top - pad_y)),
+                  min(width, int(right + pad_x)), min(height, int(bottom + pad_y)))
+        # Zero sized boxes and boxes outside of the frame have nothing to encode
+        if region[0] >= region[2] or region[1] >= region[3]:
+            crops.append(None)
+            continue
+        crop = img.crop(region)
+        if options.max_width and crop.width > options.max_width:
+            crop = crop.resize((options.max_width, max(1, round(crop.height * options.max_width / crop.width))),
+                               Image.BILINEAR)
+        with timed('encode'):
+            buffered = BytesIO()
+            crop.save(buffered, IMAGE_FORMATS[options.format][0], **crop_save_options)
+        crops.append(buffered.getvalue())
+    return crops
 
-    draw.text(lt_corner, title, font=ImageFont.truetype(
-        "app/font/RobotoMono-Bold.ttf", size=text_size))
-    return img
 
 def find_intersect_area(r0, r1):
     ''' find intersection area, return None if they are not intersect'''
@@ -36,4 +187,31 @@ def find_intersect_area(r0, r1):
     if (left < right) and (top < bottom):
         return (right - left) * (bottom - top)
     else:
-        return None
\ No newline at end of file
+        return None
+
+
+async def iter_csv(rows: AsyncIterable[dict], chunk_size: int = 64 * 1024) -> AsyncIterator[bytes]:
+    ''' Yield CSV of rows (header taken from the first row) in chunks of about chunk_size bytes '''
+    csv_stream = StringIO()
+    csv_writer = None
+    async for row in rows:
+        if csv_writer is None:
+            csv_writer = csv.DictWriter(csv_stream, fieldnames=list(row.keys()))
+            csv_writer.writeheader()
+        csv_writer.writerow(row)
+        if csv_stream.tell() >= chunk_size:
+            yield csv_stream.getvalue().encode('utf-8')
+            csv_stream.seek(0)
+            csv_stream.truncate()
+    if csv_stream.tell():
+        yield csv_stream.getvalue().encode('utf-8')
+
+
+async def iter_gzip(chunks: AsyncIterable[bytes]) -> AsyncIterator[bytes]:
+    ''' Compress a stream of chunks into a gzip stream '''
+    compressor = zlib.compressobj(wbits=31)
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
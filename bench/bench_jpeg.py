@@ -0,0 +1,57 @@
+''' CPU time and output size per image of the JPEG paths of render_image:
+
+    python -m bench.bench_jpeg
+
+Passthrough sends the S3 bytes as they are; the other rows decode and
+re-encode a full HD frame with the JPEG_* settings shown.
+'''
+import time
+from contextlib import contextmanager
+
+from app import utils
+from app.utils import bytes_to_data_uri, render_image, RenderOptions
+from bench.synthetic import synthetic_jpeg
+
+NUMBER = 20
+
+# Name -> (JPEG_* settings, render options, boxes)
+CASES = {
+    'passthrough': ({}, RenderOptions(), []),
+    'quality 75': ({}, RenderOptions(quality=75), []),
+    'source qtables': ({'JPEG_KEEP_QUANTIZATION': True}, RenderOptions(), [(100, 100, 220, 220)]),
+    'quality 75 + box': ({}, RenderOptions(), [(100, 100, 220, 220)]),
+    'progressive': ({'JPEG_PROGRESSIVE': True}, RenderOptions(quality=75), []),
+    'optimize': ({'JPEG_OPTIMIZE': True}, RenderOptions(quality=75), []),
+    'progressive + optimize': ({'JPEG_PROGRESSIVE': True, 'JPEG_OPTIMIZE': True}, RenderOptions(quality=75), []),
+    'resize 640 (draft)': ({}, RenderOptions(max_width=640), []),
+}
+
+
+@contextmanager
+def jpeg_settings(**settings):
+    previous = {name: getattr(utils, name) for name in settings}
+    for name, value in settings.items():
+        setattr(utils, name, value)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            setattr(utils, name, value)
+
+
+def main():
+    data = synthetic_jpeg(quality=90)
+    print(f"source {len(data) / 1024:.0f} KB")
+    print(f"{'case':<24} {'cpu ms':>8} {'KB':>8}")
+    for name, (settings, options, boxes) in CASES.items():
+        with jpeg_settings(**settings):
+            started = time.process_time()
+            for _ in range(NUMBER):
+                output = render_image(data, boxes, options)
+                bytes_to_data_uri(output, options.media_type)
+            cpu = (time.process_time() - started) / NUMBER
+        print(f"{name:<24} {cpu * 1000:>8.2f} {len(output) / 1024:>8.0f}")
+
+
+if __name__ == '__main__':
+    main()
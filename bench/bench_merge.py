@@ -0,0 +1,95 @@
+''' Benchmark face merging of read_all_faces_image on synthetic frames.
+
+Compare the original pairwise loop against app.merge.FaceMerger:
+
+    python -m bench.bench_merge
+'''
+import random
+import timeit
+
+from app.merge import merge_faces
+from app.routes.images import TABLE_COLUMN_NAME
+from app.utils import find_intersect_area
+
+FACE_COUNTS = (10, 50, 100, 250, 500)
+FRAME_WIDTH = 3840
+FRAME_HEIGHT = 2160
+
+
+def synthetic_frame(face_count: int, seed: int = 0):
+    ''' Results of every table for face_count faces, boxes jittered per table '''
+    rng = random.Random(seed)
+    faces = []
+    for _ in range(face_count):
+        size = rng.randint(40, 120)
+        left = rng.randint(0, FRAME_WIDTH - size)
+        top = rng.randint(0, FRAME_HEIGHT - size)
+        faces.append((left, top, size))
+
+    fetch_result = {}
+    for table, column_list in TABLE_COLUMN_NAME.items():
+        result_list = []
+        for left, top, size in faces:
+            dx, dy = rng.randint(-4, 4), rng.randint(-4, 4)
+            result = {'position_left': left + dx,
+                      'position_top': top + dy,
+                      'position_right': left + dx + size,
+                      'position_bottom': top + dy + size}
+            for column_name in column_list:
+                result[column_name] = rng.random()
+            result_list.append(result)
+        rng.shuffle(result_list)
+        fetch_result[table] = result_list
+    return fetch_result
+
+
+def merge_faces_pairwise(fetch_result):
+    ''' The original O(n^2) merging loop, kept as baseline '''
+    faces = []
+    for table, result_list in fetch_result.items():
+        for result in result_list:
+            face_index_to_update = None
+            for face_index, face in enumerate(faces):
+                area = find_intersect_area({'top': face['position_top'],
+                                            'right': face['position_right'],
+                                            'bottom': face['position_bottom'],
+                                            'left': face['position_left']},
+                                           {'top': result['position_top'],
+                                            'right': result['position_right'],
+                                            'bottom': result['position_bottom'],
+                                            'left': result['position_left']})
+                if area is not None:
+                    face_index_to_update = face_index
+                    break
+
+            if face_index_to_update is not None:
+                face = faces[face_index_to_update]
+                face["position_top"] = min(face["position_top"], result["position_top"])
+                face["position_right"] = max(face["position_right"], result["position_right"])
+                face["position_bottom"] = max(face["position_bottom"], result["position_bottom"])
+                face["position_left"] = min(face["position_left"], result["position_left"])
+            else:
+                face = {position: result[position] for position in
+                        ("position_top", "position_right", "position_bottom", "position_left")}
+                faces.append(face)
+            for column_name in TABLE_COLUMN_NAME[table]:
+                face[column_name] = result[column_name]
+    return faces
+
+
+def main():
+    print(f"{'faces':>6} {'pairwise ms':>12} {'grid ms':>10} {'speedup':>8}")
+    for face_count in FACE_COUNTS:
+        fetch_result = synthetic_frame(face_count)
+
+        # Both must merge into the same faces
+        assert merge_faces(fetch_result, TABLE_COLUMN_NAME) == merge_faces_pairwise(fetch_result)
+
+        number = max(1, 2000 // face_count)
+        pairwise = min(timeit.repeat(lambda: merge_faces_pairwise(fetch_result), number=number, repeat=3)) / number
+        grid = min(timeit.repeat(lambda: merge_faces(fetch_result, TABLE_COLUMN_NAME), number=number, repeat=3)) / number
+        print(f"{face_count:>6} {pairwise * 1000:>12.3f} {grid * 1000:>10.3f} {pairwise / grid:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
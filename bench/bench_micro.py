@@ -0,0 +1,83 @@
+''' Micro-benchmarks of the CPU-bound helpers on the request path:
+
+    python -m bench.bench_micro
+
+- face merging, the original find_intersect_area loop against FaceMerger
+- image_to_data_uri and render_image on a synthetic full HD frame
+- CSV generation of the export, plain and gzipped
+'''
+import asyncio
+import random
+import timeit
+
+from app.merge import merge_faces
+from app.routes.images import TABLE_COLUMN_NAME
+from app.utils import image_to_data_uri, render_image, iter_csv, iter_gzip, RenderOptions
+from bench.bench_merge import synthetic_frame, merge_faces_pairwise
+from bench.synthetic import synthetic_frame_image, synthetic_jpeg
+
+CSV_ROWS = 100000
+
+
+def report(name: str, number: int, seconds: float):
+    print(f"{name:<36} {seconds / number * 1000:>10.3f} ms")
+
+
+def best(fn, number: int, repeat: int = 3) -> float:
+    return min(timeit.repeat(fn, number=number, repeat=repeat))
+
+
+def bench_merge():
+    fetch_result = synthetic_frame(100)
+    report('merge pairwise, 100 faces', 20, best(lambda: merge_faces_pairwise(fetch_result), 20))
+    report('merge grid, 100 faces', 20, best(lambda: merge_faces(fetch_result, TABLE_COLUMN_NAME), 20))
+
+
+def bench_images():
+    img = synthetic_frame_image()
+    report('image_to_data_uri 1920x1080', 10, best(lambda: image_to_data_uri(img), 10))
+
+    data = synthetic_jpeg()
+    boxes = [(100, 100, 220, 220), (800, 400, 950, 550)]
+    report('render_image full size', 10, best(lambda: render_image(data, boxes), 10))
+    report('render_image small', 10, best(lambda: render_image(data, boxes, RenderOptions(max_width=320)), 10))
+
+
+def csv_rows(count: int):
+    rng = random.Random(0)
+    for face_image_id in range(count):
+        yield {'ID': face_image_id, 'Time': 1.6e9 + face_image_id, 'Branch ID': rng.randint(1, 4),
+               'Camera ID': rng.randint(1, 8), 'Image Path': f'bench/frames/{face_image_id % 50:06d}.jpg',
+               'Gender': rng.choice(('Male', 'Female')), 'Gender Confidence': rng.random(),
+               'Min Age': 21, 'Max Age': 30, 'Age Confidence': rng.random(),
+               'Race': 'Asian', 'Race Confidence': rng.random()}
+
+
+async def consume(chunks) -> int:
+    size = 0
+    async for chunk in chunks:
+        size += len(chunk)
+    return size
+
+
+async def as_async(rows):
+    for row in rows:
+        yield row
+
+
+def bench_csv():
+    rows = list(csv_rows(CSV_ROWS))
+    report(f'iter_csv {CSV_ROWS} rows', 1,
+           best(lambda: asyncio.run(consume(iter_csv(as_async(rows)))), 1))
+    report(f'iter_csv + iter_gzip {CSV_ROWS} rows', 1,
+           best(lambda: asyncio.run(consume(iter_gzip(iter_csv(as_async(rows))))), 1))
+
+
+def main():
+    bench_merge()
+    bench_images()
+    bench_csv()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+''' Drive the endpoints of a running service at fixed concurrency.
+
+Start the service against data made by bench.seed, then:
+
+    python -m bench.load --url http://127.0.0.1:8000 --concurrency 16 --duration 10 \
+        --pid $(pgrep -o gunicorn)
+
+Each endpoint is run in turn for --duration seconds after a short warm-up and
+reports p50/p95/p99 latency, requests per second, errors, and the peak RSS of
+--pid and its children (workers and render processes) while it ran.
+'''
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import httpx
+import psutil
+
+DAY = 24 * 60 * 60
+
+
+def random_ids(rng: random.Random, count: int, number: int):
+    return ','.join(str(rng.randint(1, count)) for _ in range(number))
+
+
+def scenarios(face_images: int, images: int):
+    ''' Endpoint name -> function returning the next path to request '''
+    now = time.time()
+    return {
+        'result_latest': lambda rng: '/_api/result/latest',
+        'result': lambda rng: f'/_api/result/{rng.randint(1, face_images)}',
+        'result_no_inline': lambda rng: f'/_api/result/{rng.randint(1, face_images)}?inline=false',
+        'result_thumbnail': lambda rng: f'/_api/result/{rng.randint(1, face_images)}?size=thumbnail',
+        'result_image': lambda rng: f'/_api/result/{rng.randint(1, face_images)}/image',
+        'result_batch': lambda rng: f'/_api/result?ids={random_ids(rng, face_images, 10)}',
+        'result_csv': lambda rng: f'/_api/result/csv?start={now - DAY}&end={now}',
+        'result_stats': lambda rng: f'/_api/result/stats?start={now - 7 * DAY}&end={now}',
+        'image': lambda rng: f'/_api/images/{rng.randint(1, images)}',
+        'image_raw': lambda rng: f'/_api/images/{rng.randint(1, images)}/raw',
+        'image_faces': lambda rng: f'/_api/images/{rng.randint(1, images)}/faces',
+        'image_crops': lambda rng: f'/_api/images/{rng.randint(1, images)}/faces/crops',
+        'images_bulk': lambda rng: f'/_api/images/bulk?ids={random_ids(rng, images, 20)}&size=small',
+        'images_list': lambda rng: '/_api/images/?limit=100',
+    }
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    ''' Nearest-rank percentile of already sorted values '''
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+class RssSampler:
+    ''' Track the peak RSS of a process tree in the background '''
+
+    def __init__(self, pid: int = None, interval: float = 0.1):
+        self.process = psutil.Process(pid) if pid else None
+        self.interval = interval
+        self.peak = 0
+
+    def sample(self):
+        total = 0
+        for process in [self.process] + self.process.children(recursive=True):
+            try:
+                total += process.memory_info().rss
+            except psutil.NoSuchProcess:
+                pass
+        self.peak = max(self.peak, total)
+
+    async def run(self):
+        while True:
+            self.sample()
+            await asyncio.sleep(self.interval)
+
+
+async def run_endpoint(client: httpx.AsyncClient, next_path, concurrency: int, duration: float,
+                       warmup: int, rss: RssSampler, seed: int):
+    ''' Requests made by concurrency workers during duration seconds '''
+    rng = random.Random(seed)
+    for _ in range(warmup):
+        try:
+            await client.get(next_path(rng))
+        except httpx.HTTPError:
+            pass
+
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                response = await client.get(next_path(rng))
+                if response.status_code >= 400:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    sampler = asyncio.ensure_future(rss.run()) if rss.process else None
+    rss.peak = 0
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    if sampler is not None:
+        sampler.cancel()
+
+    latencies.sort()
+    return {'requests': len(latencies),
+            'errors': errors,
+            'rps': len(latencies) / elapsed,
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'peak_rss_mb': rss.peak / 2 ** 20 if rss.process else None}
+
+
+async def run(args):
+    endpoints = scenarios(args.face_images, args.images)
+    names = args.endpoints.split(',') if args.endpoints else list(endpoints)
+    unknown = set(names) - set(endpoints)
+    if unknown:
+        raise SystemExit(f"unknown endpoints: {', '.join(sorted(unknown))}")
+
+    rss = RssSampler(args.pid)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    reports = {}
+    print(f"{'endpoint':<18} {'requests':>8} {'errors':>6} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'p99 ms':>8} {'rss MB':>8}")
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=args.timeout) as client:
+        for name in names:
+            report = await run_endpoint(client, endpoints[name], args.concurrency, args.duration,
+                                        args.warmup, rss, args.seed)
+            reports[name] = report
+            peak_rss = f"{report['peak_rss_mb']:.0f}" if report['peak_rss_mb'] is not None else '-'
+            print(f"{name:<18} {report['requests']:>8} {report['errors']:>6} {report['rps']:>8.1f} "
+                  f"{report['p50_ms']:>8.1f} {report['p95_ms']:>8.1f} {report['p99_ms']:>8.1f} {peak_rss:>8}")
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump({'settings': vars(args), 'endpoints': reports}, json_file, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10, help="seconds per endpoint")
+    parser.add_argument('--warmup', type=int, default=10, help="requests per endpoint before measuring")
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--endpoints', help="comma-separated names, all by default")
+    parser.add_argument('--face-images', type=int, default=10000, help="as given to bench.seed")
+    parser.add_argument('--images', type=int, default=1000, help="as given to bench.seed")
+    parser.add_argument('--pid', type=int, help="service process whose tree RSS is sampled")
+    parser.add_argument('--json', help="also write the report to this file")
+    parser.add_argument('--seed', type=int, default=0)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+-- Tables of the face_recognition database as read by the service.
+-- Created by python -m bench.seed, indexes come from migrations/002_face_recognition_indexes.sql
+
+CREATE TABLE IF NOT EXISTS image (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    path VARCHAR(255) NOT NULL,
+    `timestamp` DOUBLE NOT NULL,
+    gender_timestamp DOUBLE,
+    age_timestamp DOUBLE,
+    emotion_timestamp DOUBLE,
+    face_recognition_timestamp DOUBLE
+);
+
+CREATE TABLE IF NOT EXISTS age (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    image_id INT NOT NULL,
+    `timestamp` DOUBLE NOT NULL,
+    position_top INT NOT NULL,
+    position_right INT NOT NULL,
+    position_bottom INT NOT NULL,
+    position_left INT NOT NULL,
+    `0_to_10_confidence` DOUBLE,
+    `11_to_20_confidence` DOUBLE,
+    `21_to_30_confidence` DOUBLE,
+    `31_to_40_confidence` DOUBLE,
+    `41_to_50_confidence` DOUBLE,
+    `51_to_60_confidence` DOUBLE,
+    `61_to_70_confidence` DOUBLE,
+    `71_to_100_confidence` DOUBLE
+);
+
+CREATE TABLE IF NOT EXISTS gender (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    image_id INT NOT NULL,
+    `timestamp` DOUBLE NOT NULL,
+    position_top INT NOT NULL,
+    position_right INT NOT NULL,
+    position_bottom INT NOT NULL,
+    position_left INT NOT NULL,
+    male_confidence DOUBLE,
+    female_confidence DOUBLE
+);
+
+CREATE TABLE IF NOT EXISTS emotion (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    image_id INT NOT NULL,
+    `timestamp` DOUBLE NOT NULL,
+    position_top INT NOT NULL,
+    position_right INT NOT NULL,
+    position_bottom INT NOT NULL,
+    position_left INT NOT NULL,
+    uncertain_confidence DOUBLE,
+    angry_confidence DOUBLE,
+    disgusted_confidence DOUBLE,
+    fearful_confidence DOUBLE,
+    happy_confidence DOUBLE,
+    neutral_confidence DOUBLE,
+    sad_confidence DOUBLE,
+    surprised_confidence DOUBLE
+);
+
+CREATE TABLE IF NOT EXISTS face_recognition (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    image_id INT NOT NULL,
+    `timestamp` DOUBLE NOT NULL,
+    position_top INT NOT NULL,
+    position_right INT NOT NULL,
+    position_bottom INT NOT NULL,
+    position_left INT NOT NULL,
+    label VARCHAR(64)
+);
@@ -0,0 +1,36 @@
+-- Tables of MYSQL_DB (FaceImage, Gender, Age, Race) as read by the service.
+-- Created by python -m bench.seed, indexes come from migrations/001_result_indexes.sql
+
+CREATE TABLE IF NOT EXISTS FaceImage (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    image_path VARCHAR(255) NOT NULL,
+    camera_id INT NOT NULL,
+    branch_id INT NOT NULL,
+    `time` DOUBLE NOT NULL,
+    position_top INT,
+    position_right INT,
+    position_bottom INT,
+    position_left INT
+);
+
+CREATE TABLE IF NOT EXISTS Gender (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    face_image_id INT NOT NULL,
+    type VARCHAR(16) NOT NULL,
+    confidence DOUBLE NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS Race (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    face_image_id INT NOT NULL,
+    type VARCHAR(16) NOT NULL,
+    confidence DOUBLE NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS Age (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    face_image_id INT NOT NULL,
+    min_age INT NOT NULL,
+    max_age INT NOT NULL,
+    confidence DOUBLE NOT NULL
+);
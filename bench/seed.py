@@ -0,0 +1,189 @@
+''' Seed the MySQL and S3 stand-ins of bench/docker-compose.yml with synthetic data.
+
+Uses the usual MYSQL_* and S3_* variables of the service:
+
+    python -m bench.seed --face-images 100000 --images 10000 --indexes
+
+Creates the tables of bench/schema_*.sql, fills FaceImage, Gender, Race and
+Age in MYSQL_DB and image and its stage tables in face_recognition, spread
+over the last --days days, and uploads --objects distinct JPEGs to --bucket.
+Rows point at these objects round-robin. Ids start at 1, which is what
+bench.load assumes.
+'''
+import argparse
+import os
+import random
+import time
+
+import pymysql
+from botocore.session import get_session
+
+from app.config import MYSQL_CONFIG, MYSQL_CONFIG_FADE, S3_ENDPOINT, S3_ACCESS_KEY, S3_SECRET_KEY
+from app.routes.images import TABLE_COLUMN_NAME
+from bench.synthetic import FRAME_SIZE, synthetic_jpeg
+
+BENCH_DIR = os.path.dirname(__file__)
+MIGRATIONS_DIR = os.path.join(BENCH_DIR, '..', 'migrations')
+
+GENDERS = ('Male', 'Female')
+RACES = ('Asian', 'White', 'Black', 'Indian', 'Others')
+AGE_BANDS = ((0, 10), (11, 20), (21, 30), (31, 40), (41, 50), (51, 60), (61, 70), (71, 100))
+LABELS = tuple(f'person_{index}' for index in range(50))
+
+
+def run_sql_file(connection, path: str):
+    ''' Execute each statement of a ;-separated SQL file '''
+    with open(path) as sql_file:
+        lines = [line for line in sql_file if not line.lstrip().startswith('--')]
+    with connection.cursor() as cursor:
+        for statement in ''.join(lines).split(';'):
+            if statement.strip():
+                cursor.execute(statement)
+
+
+def connect(config: dict):
+    ''' Connect to the database of config, creating it if needed '''
+    server = pymysql.connect(**{key: value for key, value in config.items() if key != 'db'})
+    with server.cursor() as cursor:
+        cursor.execute(f"CREATE DATABASE IF NOT EXISTS `{config['db']}`")
+    server.close()
+    return pymysql.connect(**config, autocommit=True)
+
+
+def insert_many(connection, table: str, rows: list, batch_size: int):
+    if not rows:
+        return
+    columns = list(rows[0])
+    query = (f"INSERT INTO {table} ({', '.join(f'`{column}`' for column in columns)}) "
+             f"VALUES ({', '.join(['%s'] * len(columns))})")
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), batch_size):
+            cursor.executemany(query, [tuple(row[column] for column in columns)
+                                       for row in rows[start:start + batch_size]])
+
+
+def random_box(rng: random.Random):
+    width, height = FRAME_SIZE
+    size = rng.randint(60, 200)
+    left, top = rng.randint(0, width - size), rng.randint(0, height - size)
+    return {'position_top': top, 'position_right': left + size,
+            'position_bottom': top + size, 'position_left': left}
+
+
+def upload_objects(bucket: str, count: int):
+    ''' Upload count distinct frames, return their s3 paths '''
+    client = get_session().create_client('s3', endpoint_url=S3_ENDPOINT,
+                                         aws_access_key_id=S3_ACCESS_KEY,
+                                         aws_secret_access_key=S3_SECRET_KEY)
+    try:
+        client.create_bucket(Bucket=bucket)
+    except client.exceptions.BucketAlreadyOwnedByYou:
+        pass
+    paths = []
+    for index in range(count):
+        key = f'frames/{index:06d}.jpg'
+        client.put_object(Bucket=bucket, Key=key, Body=synthetic_jpeg(seed=index), ContentType='image/jpeg')
+        paths.append(f'{bucket}/{key}')
+    return paths
+
+
+def seed_results(rng: random.Random, paths: list, count: int, start: float, end: float, batch_size: int):
+    connection = connect(MYSQL_CONFIG)
+    run_sql_file(connection, os.path.join(BENCH_DIR, 'schema_results.sql'))
+
+    for offset in range(0, count, batch_size):
+        face_images, genders, races, ages = [], [], [], []
+        for face_image_id in range(offset + 1, min(offset + batch_size, count) + 1):
+            face_images.append(dict(id=face_image_id,
+                                    image_path=paths[face_image_id % len(paths)],
+                                    camera_id=rng.randint(1, 8),
+                                    branch_id=rng.randint(1, 4),
+                                    time=rng.uniform(start, end),
+                                    **random_box(rng)))
+            genders.append({'face_image_id': face_image_id, 'type': rng.choice(GENDERS),
+                            'confidence': rng.random()})
+            races.append({'face_image_id': face_image_id, 'type': rng.choice(RACES),
+                          'confidence': rng.random()})
+            min_age, max_age = rng.choice(AGE_BANDS)
+            ages.append({'face_image_id': face_image_id, 'min_age': min_age, 'max_age': max_age,
+                         'confidence': rng.random()})
+        insert_many(connection, 'FaceImage', face_images, batch_size)
+        insert_many(connection, 'Gender', genders, batch_size)
+        insert_many(connection, 'Race', races, batch_size)
+        insert_many(connection, 'Age', ages, batch_size)
+    return connection
+
+
+def stage_value(rng: random.Random, column_name: str):
+    return rng.choice(LABELS) if column_name == 'label' else rng.random()
+
+
+def seed_images(rng: random.Random, paths: list, count: int, faces_per_image: int,
+                start: float, end: float, batch_size: int):
+    connection = connect(MYSQL_CONFIG_FADE)
+    run_sql_file(connection, os.path.join(BENCH_DIR, 'schema_face_recognition.sql'))
+
+    for offset in range(0, count, batch_size):
+        images = []
+        results = {table: [] for table in TABLE_COLUMN_NAME}
+        for image_id in range(offset + 1, min(offset + batch_size, count) + 1):
+            timestamp = start + (end - start) * image_id / count
+            image = {'id': image_id, 'path': paths[image_id % len(paths)], 'timestamp': timestamp}
+            boxes = [random_box(rng) for _ in range(rng.randint(0, faces_per_image * 2))]
+            for table, column_list in TABLE_COLUMN_NAME.items():
+                # Some stages have not landed yet on part of the images
+                if rng.random() < 0.1:
+                    image[f'{table}_timestamp'] = None
+                    continue
+                image[f'{table}_timestamp'] = timestamp + rng.uniform(0.1, 5)
+                for box in boxes:
+                    # Each stage detects the same face with a slightly different box
+                    jitter = rng.randint(-4, 4)
+                    result = {'image_id': image_id, 'timestamp': image[f'{table}_timestamp'],
+                              **{position: value + jitter for position, value in box.items()}}
+                    for column_name in column_list:
+                        result[column_name] = stage_value(rng, column_name)
+                    results[table].append(result)
+            images.append(image)
+        insert_many(connection, 'image', images, batch_size)
+        for table, rows in results.items():
+            insert_many(connection, table, rows, batch_size)
+    return connection
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--face-images', type=int, default=10000, help="rows of FaceImage, Gender, Race and Age")
+    parser.add_argument('--images', type=int, default=1000, help="rows of face_recognition.image")
+    parser.add_argument('--faces-per-image', type=int, default=3, help="average faces per image and stage")
+    parser.add_argument('--objects', type=int, default=50, help="distinct JPEGs uploaded to S3")
+    parser.add_argument('--bucket', default='bench')
+    parser.add_argument('--days', type=float, default=30, help="time span of the rows, ending now")
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--indexes', action='store_true', help="also create the indexes of migrations/")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    end = time.time()
+    start = end - args.days * 24 * 60 * 60
+
+    started = time.perf_counter()
+    paths = upload_objects(args.bucket, args.objects)
+    print(f"uploaded {len(paths)} objects in {time.perf_counter() - started:.1f}s")
+
+    started = time.perf_counter()
+    connection = seed_results(rng, paths, args.face_images, start, end, args.batch_size)
+    if args.indexes:
+        run_sql_file(connection, os.path.join(MIGRATIONS_DIR, '001_result_indexes.sql'))
+    print(f"inserted {args.face_images} face images in {time.perf_counter() - started:.1f}s")
+
+    started = time.perf_counter()
+    connection = seed_images(rng, paths, args.images, args.faces_per_image, start, end, args.batch_size)
+    if args.indexes:
+        run_sql_file(connection, os.path.join(MIGRATIONS_DIR, '002_face_recognition_indexes.sql'))
+    print(f"inserted {args.images} images in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+''' Synthetic camera frames shared by the seed script and the micro-benchmarks '''
+import random
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+
+FRAME_SIZE = (1920, 1080)
+
+
+def synthetic_frame_image(size=FRAME_SIZE, seed: int = 0) -> Image.Image:
+    ''' RGB frame with noise and shapes, so it compresses about like a real one '''
+    rng = random.Random(seed)
+    img = Image.merge('RGB', [Image.effect_noise(size, rng.randint(20, 60)) for _ in range(3)])
+    draw = ImageDraw.Draw(img)
+    width, height = size
+    for _ in range(30):
+        left, top = rng.randint(0, width), rng.randint(0, height)
+        right, bottom = left + rng.randint(20, width // 4), top + rng.randint(20, height // 4)
+        color = tuple(rng.randint(0, 255) for _ in range(3))
+        if rng.random() < 0.5:
+            draw.rectangle([left, top, right, bottom], fill=color)
+        else:
+            draw.ellipse([left, top, right, bottom], fill=color)
+    return img
+
+
+def synthetic_jpeg(size=FRAME_SIZE, seed: int = 0, quality: int = 85) -> bytes:
+    buffered = BytesIO()
+    synthetic_frame_image(size, seed).save(buffered, 'JPEG', quality=quality)
+    return buffered.getvalue()
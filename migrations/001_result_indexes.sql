@@ -0,0 +1,13 @@
+-- Indexes for the result queries of MYSQL_DB (FaceImage, Gender, Age, Race).
+-- Run once: mysql "$MYSQL_DB" < migrations/001_result_indexes.sql
+
+-- Time range filters of the CSV export and stats, and ORDER BY time DESC of "latest"
+CREATE INDEX idx_faceimage_time_branch_camera ON FaceImage (time, branch_id, camera_id);
+
+-- Exports and stats of one branch or camera without a time range
+CREATE INDEX idx_faceimage_branch_camera_time ON FaceImage (branch_id, camera_id, time);
+
+-- Joins from FaceImage, covering the exact-match type filters
+CREATE INDEX idx_gender_face_image_type ON Gender (face_image_id, type);
+CREATE INDEX idx_race_face_image_type ON Race (face_image_id, type);
+CREATE INDEX idx_age_face_image_ages ON Age (face_image_id, min_age, max_age);
@@ -0,0 +1,11 @@
+-- Indexes for the image queries of the face_recognition database.
+-- Run once: mysql face_recognition < migrations/002_face_recognition_indexes.sql
+
+-- Keyset pagination of the image listing and the "latest" image
+CREATE INDEX idx_image_timestamp_id ON image (timestamp, id);
+
+-- Results of one image from each stage, in insertion order
+CREATE INDEX idx_age_image_timestamp ON age (image_id, timestamp);
+CREATE INDEX idx_gender_image_timestamp ON gender (image_id, timestamp);
+CREATE INDEX idx_emotion_image_timestamp ON emotion (image_id, timestamp);
+CREATE INDEX idx_face_recognition_image_timestamp ON face_recognition (image_id, timestamp);
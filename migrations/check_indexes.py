@@ -0,0 +1,80 @@
+''' Check with EXPLAIN that the queries of the service use the migration indexes.
+
+Runs against the database configured by the usual MYSQL_* variables, which
+should hold representative data since MySQL ignores indexes on tiny tables:
+
+    python -m migrations.check_indexes
+
+Exits with status 1 if a query plan does not use the expected index.
+'''
+import sys
+
+import pymysql
+from pymysql.cursors import DictCursor
+
+from app.config import MYSQL_CONFIG, MYSQL_CONFIG_FADE
+from app.query import ResultFilter, result_csv_query, result_stats_query, image_list_query
+from app.routes.images import TABLE_COLUMN_NAME
+
+DAY = 24 * 60 * 60
+
+
+def result_checks():
+    ''' (description, query, params, table, expected indexes) of MYSQL_DB '''
+    joined = ('Gender', {'idx_gender_face_image_type'}), ('Race', {'idx_race_face_image_type'}), \
+             ('Age', {'idx_age_face_image_ages'})
+
+    query, params = result_csv_query(ResultFilter(start=0, end=DAY))
+    yield 'csv export by time', query, params, 'FaceImage', {'idx_faceimage_time_branch_camera'}
+    for table, indexes in joined:
+        yield f'csv export join {table}', query, params, table, indexes
+
+    query, params = result_csv_query(ResultFilter(branch=1, camera=1))
+    yield 'csv export by branch and camera', query, params, 'FaceImage', {'idx_faceimage_branch_camera_time'}
+
+    query, params = result_csv_query(ResultFilter(start=0, end=DAY, gender='Male'))
+    yield 'csv export by gender', query, params, 'Gender', {'idx_gender_face_image_type'}
+
+    query, params = result_stats_query(ResultFilter(start=0, end=DAY), 3600)
+    yield 'stats by time', query, params, 'FaceImage', {'idx_faceimage_time_branch_camera'}
+
+    yield ('latest face image', "SELECT id FROM FaceImage ORDER BY time DESC LIMIT 1", None,
+           'FaceImage', {'idx_faceimage_time_branch_camera'})
+
+
+def face_recognition_checks():
+    ''' (description, query, params, table, expected indexes) of the face_recognition database '''
+    query, params = image_list_query(since=0, cursor=(DAY, 1), limit=100)
+    yield 'image listing', query, params, 'image', {'idx_image_timestamp_id', 'PRIMARY'}
+
+    for table, column_list in TABLE_COLUMN_NAME.items():
+        yield (f'{table} results of an image',
+               f"SELECT id, {', '.join(column_list)} FROM {table} WHERE image_id=%(image_id)s ORDER BY timestamp",
+               {'image_id': 1}, table, {f'idx_{table}_image_timestamp'})
+
+
+def check(config: dict, checks) -> bool:
+    ok = True
+    connection = pymysql.connect(**config)
+    try:
+        with connection.cursor(DictCursor) as cursor:
+            for description, query, params, table, indexes in checks:
+                cursor.execute("EXPLAIN " + query, params)
+                plan = {row['table']: row for row in cursor.fetchall()}
+                key = plan.get(table, {}).get('key')
+                passed = key in indexes
+                ok = ok and passed
+                print(f"{'ok  ' if passed else 'FAIL'} {description}: {table} uses {key}, expected {' or '.join(sorted(indexes))}")
+    finally:
+        connection.close()
+    return ok
+
+
+def main():
+    results_ok = check(MYSQL_CONFIG, result_checks())
+    face_recognition_ok = check(MYSQL_CONFIG_FADE, face_recognition_checks())
+    sys.exit(0 if results_ok and face_recognition_ok else 1)
+
+
+if __name__ == '__main__':
+    main()